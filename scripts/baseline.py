@@ -0,0 +1,149 @@
+"""
+The residue-analysis parser of the baseline, before the streaming and
+columnar rewrite. It reads the whole output with csv.DictReader and builds
+a pydantic `Residue` per row, the benchmarks and tests compare the current
+parser with it.
+"""
+
+import csv
+from typing import Any
+
+from sqc.validation.model import (
+    OmegaTorsion,
+    RamaTorsion,
+    Residue,
+    SidechainTorsion,
+    WorstBondAngle,
+    WorstBondLength,
+    WorstClash,
+)
+
+
+def _nullify_row(row: dict[str, Any]) -> None:
+    """Changes dict values from empty strings to None"""
+    for key, val in row.items():
+        if val == "":
+            row[key] = None
+
+
+def _get_analysis_dict(output: str) -> dict[str, Any]:
+    reader = csv.DictReader(output.splitlines(), dialect="unix")
+
+    per_residue_analysis: dict[str, Any] = {}
+    for residue_row in reader:
+        residue = residue_row.pop("residue")
+        _nullify_row(residue_row)
+        per_residue_analysis[residue] = residue_row
+
+    return per_residue_analysis
+
+
+def _parse_residue(residue: str) -> Residue:
+    split = residue.split()
+
+    # When the residue number is 4 digits long, it gets joined with the
+    # chain ID in the residue-analysis output. "X1194 TYR" instead of
+    # "X 1194 TYR"
+    if len(split[0]) == 5:
+        chain = split[0][0]
+        number = int(split[0][1:])
+        remaining_part = split[1:]
+    else:
+        chain = split[0]
+        number = int(split[1])
+        remaining_part = split[2:]
+
+    if len(remaining_part) == 1:
+        part = remaining_part[0]
+
+        # if the residue is not 3 characters long (e.g. LYS, ARG),
+        # it has the altcode prepended (e.g. ALYS, BARG)
+        if len(part) == 4:
+            alt_code = part[0]
+            type = part[1:]
+        else:
+            alt_code = None
+            type = part
+    else:
+        alt_code = remaining_part[0]
+        type = remaining_part[1]
+
+    return Residue(number=number, chain=chain, residue_type=type, alt_code=alt_code)
+
+
+def _parse_worst_length(analysis: dict[str, Any]) -> WorstBondLength:
+    first_atom, second_atom = analysis["worst_length"].split("--")
+    length = analysis["worst_length_value"]
+    sigma = analysis["worst_length_sigma"]
+
+    return WorstBondLength(
+        first_atom=first_atom, second_atom=second_atom, length=length, sigma=sigma
+    )
+
+
+def _parse_worst_angle(analysis: dict[str, Any]) -> WorstBondAngle:
+    first_atom, second_atom, third_atom = analysis["worst_angle"].split("-")
+    angle = analysis["worst_angle_value"]
+    sigma = analysis["worst_angle_sigma"]
+
+    return WorstBondAngle(
+        first_atom=first_atom,
+        second_atom=second_atom,
+        third_atom=third_atom,
+        angle=angle,
+        sigma=sigma,
+    )
+
+
+def residue_analysis(output: str) -> list[Residue]:
+    all_analysis = _get_analysis_dict(output)
+    residues = []
+
+    for residue_id, analysis in all_analysis.items():
+        residue = _parse_residue(residue_id)
+
+        if analysis["worst_clash"] is not None:
+            magnitude = float(analysis["worst_clash"])
+            atom = analysis["src_atom"].strip()
+            other_atom = analysis["dst_atom"].strip()
+            dst_residue = _parse_residue(analysis["dst_residue"])
+
+            residue.worst_clash = WorstClash(
+                magnitude=magnitude,
+                atom=atom,
+                other_atom=other_atom,
+                other_residue=dst_residue,
+            )
+
+        if analysis["num_length_out"] is not None:
+            residue.bond_length_outlier_count = int(analysis["num_length_out"])
+            residue.worst_bond_length = _parse_worst_length(analysis)
+
+        if analysis["num_angle_out"] is not None:
+            residue.bond_angle_outlier_count = int(analysis["num_angle_out"])
+            residue.worst_bond_angle = _parse_worst_angle(analysis)
+
+        if analysis["omega"] is not None:
+            angle = float(analysis["omega"])
+            angle_range = analysis["omega_eval"]
+            residue.omega_torsion = OmegaTorsion(angle=angle, angle_range=angle_range)
+
+        if analysis["rama_eval"] is not None:
+            residue.rama_torsion = RamaTorsion(angle_combo_range=analysis["rama_eval"])
+
+        if analysis["rotamer_eval"] is not None:
+            residue.sidechain_torsion = SidechainTorsion(
+                angle_range=analysis["rotamer_eval"], rotamer=analysis["rotamer"]
+            )
+
+        # skip residue if no outliers found
+        if (
+            residue.bond_angle_outlier_count is not None
+            or residue.bond_length_outlier_count is not None
+            or residue.omega_torsion is not None
+            or residue.sidechain_torsion is not None
+            or residue.rama_torsion is not None
+        ):
+            residues.append(residue)
+
+    return residues
@@ -0,0 +1,296 @@
+"""
+End-to-end throughput and latency benchmark of the worker.
+
+Drives real Worker instances through kombu's in-memory transport and an
+in-memory MinIO stand-in. MolProbity is replaced by an engine that replays
+recorded (or synthetic) tool outputs after a delay proportional to the
+model size, so the measured CPU time is the Python side of the worker:
+
+    pdm run e2e-benchmark --atoms 1000,10000 --models 1,5 --threads 1,4
+    pdm run e2e-benchmark --recordings recorded/ --output results.json
+
+A recordings directory holds outputs captured with
+
+    residue-analysis model.pdb > recorded/residue-analysis.out
+    clashscore model.pdb > recorded/clashscore.out
+
+Every sweep point runs in a fresh process, so that its peak RSS is its own.
+Results are printed as JSON, one object per sweep point.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import string
+import sys
+import tempfile
+import threading
+import time
+from typing import Any
+
+from kombu import Connection, Producer
+import structlog
+import urllib3
+
+from scripts.replay import ReplayEngine
+from sqc.repository import MinioRepo
+from sqc.validation.engine import set_default_engine
+from sqc.worker import Worker
+
+
+class MemoryMinio:
+    """The part of the minio.Minio API used by SQC, backed by dicts"""
+
+    def __init__(self) -> None:
+        self.objects: dict[tuple[str, str], tuple[bytes, dict[str, str]]] = {}
+        self.put_times: dict[str, float] = {}
+        self.buckets: set[str] = set()
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+
+    def bucket_exists(self, bucket: str) -> bool:
+        return bucket in self.buckets
+
+    def make_bucket(self, bucket: str) -> None:
+        self.buckets.add(bucket)
+
+    def set_bucket_notification(self, bucket: str, config: Any) -> None:
+        pass
+
+    def upload(self, bucket: str, name: str, data: bytes, metadata: dict) -> None:
+        headers = {f"X-Amz-Meta-{key}": value for key, value in metadata.items()}
+        with self.lock:
+            self.objects[(bucket, name)] = (data, headers)
+
+    def get_object(self, bucket: str, name: str) -> urllib3.HTTPResponse:
+        with self.lock:
+            data, headers = self.objects[(bucket, name)]
+        return urllib3.HTTPResponse(
+            io.BytesIO(data), headers=headers, preload_content=False
+        )
+
+    def put_object(self, bucket: str, name: str, data, length: int, **kwargs) -> None:
+        body = data.read() if length < 0 else data.read(length)
+        with self.written:
+            self.objects[(bucket, name)] = (body, kwargs.get("metadata") or {})
+            self.put_times[name] = time.perf_counter()
+            self.written.notify_all()
+
+    def remove_object(self, bucket: str, name: str) -> None:
+        with self.lock:
+            self.objects.pop((bucket, name), None)
+
+
+def synthetic_pdb(atoms: int, models: int, seed: int) -> bytes:
+    """PDB file of `models` distinct models of alanine chains"""
+    rng = random.Random(seed)
+    names = [(" N  ", "N"), (" CA ", "C"), (" C  ", "C"), (" O  ", "O"), (" CB ", "C")]
+    residues = max(atoms // len(names), 1)
+
+    lines = [
+        f"HEADER    BENCHMARK                               01-JAN-24   {seed:04d}"
+    ]
+    for model in range(1, models + 1):
+        if models > 1:
+            lines.append(f"MODEL     {model:4d}")
+        serial = 1
+        for residue in range(residues):
+            chain = string.ascii_uppercase[residue // 9999 % 26]
+            number = residue % 9999 + 1
+            for name, element in names:
+                x, y, z = (rng.uniform(-99, 99) for _ in range(3))
+                lines.append(
+                    f"ATOM  {serial % 100000:5d} {name} ALA {chain}{number:4d}    "
+                    f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          {element:>2}"
+                )
+                serial += 1
+        if models > 1:
+            lines.append("ENDMDL")
+    lines.append("END")
+
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def percentile(values: list[float], p: int) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def run_point(point: dict[str, Any], options: dict[str, Any]) -> dict[str, Any]:
+    """Runs one sweep point, in its own process"""
+    os.environ["PREFETCH_COUNT"] = str(point["prefetch"])
+    scratch = tempfile.mkdtemp(prefix="sqc-benchmark-")
+    os.environ["SCRATCH_DIR"] = scratch
+    # per-request log lines would dominate the CPU time of small structures
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+
+    delays = options["tool_delay"], options["tool_delay_per_atom"]
+    if options["recordings"] is not None:
+        set_default_engine(ReplayEngine.from_recordings(options["recordings"], *delays))
+    else:
+        set_default_engine(ReplayEngine(None, *delays))
+
+    storage = MemoryMinio()
+    repo = MinioRepo(storage)
+
+    requests = [f"bench-{i}" for i in range(options["requests"])]
+    # a few distinct structures, so that nothing can be cached by accident
+    structures = [
+        synthetic_pdb(point["atoms"], point["models"], seed) for seed in range(4)
+    ]
+    for i, request in enumerate(requests):
+        storage.upload(
+            repo.request_bucket,
+            request,
+            structures[i % len(structures)],
+            {"Ftype": "pdb", "Filename": f"{request}.pdb"},
+        )
+
+    workers = []
+    threads = []
+    for i in range(point["threads"]):
+        worker = Worker(repo)
+        worker.connection = Connection("memory://")
+        workers.append(worker)
+        threads.append(threading.Thread(target=worker.run, name=f"worker-{i}"))
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    published: dict[str, float] = {}
+    with Connection("memory://") as connection:
+        producer = Producer(connection)
+        for request in requests:
+            published[request] = time.perf_counter()
+            producer.publish(
+                {
+                    "EventName": "s3:ObjectCreated:Put",
+                    "Records": [
+                        {
+                            "eventTime": datetime.now(timezone.utc).isoformat(),
+                            "s3": {"object": {"key": request}},
+                        }
+                    ],
+                },
+                exchange=Worker.queue.exchange,
+                declare=[Worker.queue],
+                serializer="json",
+            )
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    names = {f"{request}.json" for request in requests}
+    with storage.written:
+        finished = storage.written.wait_for(
+            lambda: names <= storage.put_times.keys(), timeout=options["timeout"]
+        )
+    end = time.perf_counter()
+
+    for worker in workers:
+        worker.should_stop = True
+    for thread in threads:
+        thread.join()
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    latencies = sorted(
+        storage.put_times[f"{request}.json"] - published[request]
+        for request in requests
+        if f"{request}.json" in storage.put_times
+    )
+    errors = sum(
+        1
+        for (bucket, _), (_, metadata) in storage.objects.items()
+        if bucket == repo.result_bucket and "sqc-error" in metadata
+    )
+
+    return {
+        **point,
+        "requests": len(requests),
+        "completed": len(latencies),
+        "errors": errors,
+        "timed_out": not finished,
+        "wall_seconds": round(end - start, 3),
+        "throughput_per_second": round(len(latencies) / (end - start), 3),
+        "latency_p50": round(percentile(latencies, 50), 3) if latencies else None,
+        "latency_p95": round(percentile(latencies, 95), 3) if latencies else None,
+        "latency_p99": round(percentile(latencies, 99), 3) if latencies else None,
+        "cpu_seconds": round(
+            usage_end.ru_utime
+            - usage_start.ru_utime
+            + usage_end.ru_stime
+            - usage_start.ru_stime,
+            3,
+        ),
+        # kilobytes on Linux
+        "peak_rss_mib": round(usage_end.ru_maxrss / 1024, 1),
+    }
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--atoms", type=int_list, default=[1000, 10000])
+    parser.add_argument("--models", type=int_list, default=[1, 5])
+    parser.add_argument("--threads", type=int_list, default=[1, 4])
+    parser.add_argument("--prefetch", type=int_list, default=[1])
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--recordings", help="directory of recorded tool outputs")
+    parser.add_argument("--tool-delay", type=float, default=0.2, help="seconds")
+    parser.add_argument(
+        "--tool-delay-per-atom", type=float, default=20e-6, help="seconds"
+    )
+    parser.add_argument("--timeout", type=float, default=600, help="per sweep point")
+    parser.add_argument("--output", help="JSON file, printed when not set")
+    args = parser.parse_args()
+
+    options = {
+        "requests": args.requests,
+        "recordings": args.recordings,
+        "tool_delay": args.tool_delay,
+        "tool_delay_per_atom": args.tool_delay_per_atom,
+        "timeout": args.timeout,
+    }
+
+    results = []
+    sweep = itertools.product(args.atoms, args.models, args.threads, args.prefetch)
+    for atoms, models, threads, prefetch in sweep:
+        point = {
+            "atoms": atoms,
+            "models": models,
+            "threads": threads,
+            "prefetch": prefetch,
+        }
+        print(f"Running {point}", file=sys.stderr)
+
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results.append(executor.submit(run_point, point, options).result())
+
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
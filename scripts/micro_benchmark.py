@@ -0,0 +1,230 @@
+"""
+Micro-benchmarks of the Python-side hot paths of a request.
+
+Times model splitting, residue-analysis and clashscore output parsing and
+result serialization on a corpus of a small structure, a ribosome-sized
+one and a 50-model NMR ensemble, and records the peak traced memory of
+each function:
+
+    pdm run micro-benchmark --save baseline.json
+    pdm run micro-benchmark --compare baseline.json
+
+With --compare, the run fails when a benchmark got slower or allocates
+more than --tolerance times its baseline. The corpus is synthetic unless
+--corpus points to a directory with <name>.pdb files and optionally the
+captured <name>.residue-analysis.out and <name>.clashscore.out outputs of
+their first model.
+"""
+
+import argparse
+from dataclasses import dataclass
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable
+
+import structlog
+
+from scripts.e2e_benchmark import synthetic_pdb
+from scripts.replay import ReplayEngine, synthetic_clashscore, synthetic_output
+from sqc.validation.columns import ColumnarModel, ColumnarResult
+from sqc.validation.io import load_structure
+from sqc.validation.model import DataVersion, MolProbityVersions, Result, Status
+from sqc.validation.molprobity import MolProbity
+
+# name: (atoms per model, models); the ribosome stays below the 99999 atom
+# serial numbers of the PDB format
+CORPUS = {
+    "small": (2_000, 1),
+    "ribosome": (95_000, 1),
+    "nmr": (1_500, 50),
+}
+
+
+@dataclass
+class Structure:
+    """A corpus structure with the tool outputs of its first model"""
+
+    name: str
+    models: int
+    pdb: bytes
+    residue_analysis: bytes
+    clashscore: bytes
+
+
+def load_corpus(directory: str | None) -> list[Structure]:
+    corpus = []
+    for name, (atoms, models) in CORPUS.items():
+        pdb_path = os.path.join(directory or "", f"{name}.pdb")
+        if directory is not None and os.path.exists(pdb_path):
+            with open(pdb_path, "rb") as file:
+                pdb = file.read()
+        else:
+            pdb = synthetic_pdb(atoms, models, seed=0)
+
+        outputs = {}
+        for tool, synthetic in (
+            ("residue-analysis", lambda: synthetic_output(atoms // 5)),
+            ("clashscore", lambda: synthetic_clashscore(atoms)),
+        ):
+            path = os.path.join(directory or "", f"{name}.{tool}.out")
+            if directory is not None and os.path.exists(path):
+                with open(path, "rb") as file:
+                    outputs[tool] = file.read()
+            else:
+                outputs[tool] = synthetic()
+
+        corpus.append(
+            Structure(
+                name, models, pdb, outputs["residue-analysis"], outputs["clashscore"]
+            )
+        )
+
+    return corpus
+
+
+def versions() -> MolProbityVersions:
+    version = DataVersion(url="https://example.org/data.git", commit_sha="0" * 40)
+    return MolProbityVersions(
+        geostd_version=version,
+        mon_lib_version=version,
+        rotarama_version=version,
+        cablam_version=version,
+        rama_z_version=version,
+    )
+
+
+def benchmarks(structure: Structure, workdir: str) -> dict[str, Callable[[], Any]]:
+    """The benchmarked functions, run on `structure`"""
+    pdb_path = os.path.join(workdir, f"{structure.name}.pdb")
+    with open(pdb_path, "wb") as file:
+        file.write(structure.pdb)
+
+    mp = MolProbity(
+        engine=ReplayEngine(
+            {
+                "residue-analysis": structure.residue_analysis,
+                "clashscore": structure.clashscore,
+            }
+        )
+    )
+
+    # every model shares the results of the first one
+    result = ColumnarResult(
+        status=Status(molprobity_versions=versions()),
+        pdb_id=structure.name,
+        filename=f"{structure.name}.pdb",
+        models=[
+            ColumnarModel(
+                number,
+                mp.residue_analysis("replay"),
+                mp.clashscore("replay"),
+            )
+            for number in range(1, structure.models + 1)
+        ],
+    )
+    result_json = result.to_json()
+
+    return {
+        "split_models": lambda: load_structure(pdb_path),
+        "residue_analysis": lambda: mp.residue_analysis("replay"),
+        "clashscore": lambda: mp.clashscore("replay"),
+        "serialize": lambda: result.to_json(),
+        "serialize_stream": lambda: sum(len(chunk) for chunk in result.iter_json()),
+        # the pydantic tree results were serialized from before
+        "pydantic_dump": lambda: Result.model_validate_json(
+            result_json
+        ).model_dump_json(exclude_none=True),
+    }
+
+
+def measure(function: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """Best and median wall time of `repeat` runs and the peak traced memory"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "best_seconds": round(min(times), 6),
+        "median_seconds": round(statistics.median(times), 6),
+        "peak_bytes": peak,
+    }
+
+
+def regressions(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+    found = []
+    for name, result in results.items():
+        if (base := baseline.get(name)) is None:
+            continue
+        for metric in ("best_seconds", "peak_bytes"):
+            if base[metric] > 0 and result[metric] > base[metric] * tolerance:
+                ratio = result[metric] / base[metric]
+                found.append(f"{name} {metric}: {ratio:.2f}x of the baseline")
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--corpus", help="directory with the corpus files")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="run benchmarks containing it")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args()
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+
+    results: dict[str, dict[str, float]] = {}
+    workdir = tempfile.mkdtemp(prefix="sqc-micro-benchmark-")
+    try:
+        for structure in load_corpus(args.corpus):
+            for name, function in benchmarks(structure, workdir).items():
+                key = f"{name}[{structure.name}]"
+                if args.filter not in key:
+                    continue
+                results[key] = measure(function, args.repeat)
+                print(
+                    f"{key:>32}: {results[key]['best_seconds'] * 1000:9.1f} ms, "
+                    f"peak {results[key]['peak_bytes'] / 2**20:7.1f} MiB",
+                    file=sys.stderr,
+                )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if found := regressions(results, baseline, args.tolerance):
+            print("\n".join(found), file=sys.stderr)
+            sys.exit(1)
+        print("No regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
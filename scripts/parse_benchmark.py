@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of the residue-analysis output parser.
+
+Compares the streaming parser of MolProbity.residue_analysis with the
+baseline one, which built pydantic `Residue` models from a csv.DictReader
+(see scripts/baseline.py), on a captured residue-analysis output:
+
+    residue-analysis model.pdb > residue-analysis.csv
+    pdm run parse-benchmark residue-analysis.csv
+
+Without a captured output, a synthetic one with --residues rows is used.
+"""
+
+import argparse
+import time
+import tracemalloc
+from typing import Any, Callable
+
+from scripts import baseline
+from scripts.replay import ReplayEngine, synthetic_output
+from sqc.validation.molprobity import MolProbity
+
+
+def measure(parse: Callable[[], Any], repeat: int) -> tuple[float, int]:
+    """Returns the best wall time of `repeat` runs and the peak traced memory"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output", nargs="?", help="captured residue-analysis output")
+    parser.add_argument("--residues", type=int, default=200_000, help="max 519948")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.output is not None:
+        with open(args.output, "rb") as output_file:
+            output = output_file.read()
+    else:
+        output = synthetic_output(args.residues)
+
+    mp = MolProbity(engine=ReplayEngine({"residue-analysis": output}))
+    parsers = {
+        "baseline": lambda: baseline.residue_analysis(output.decode("utf-8")),
+        "streaming": lambda: mp.residue_analysis("replay"),
+    }
+
+    print(f"{len(output) / 2**20:.1f} MiB of residue-analysis output")
+    results = {name: measure(parse, args.repeat) for name, parse in parsers.items()}
+    for name, (best, peak) in results.items():
+        print(f"{name:>10}: {best * 1000:8.1f} ms, peak {peak / 2**20:6.1f} MiB")
+
+    speedup = results["baseline"][0] / results["streaming"][0]
+    print(f"speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
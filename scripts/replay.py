@@ -0,0 +1,140 @@
+"""
+MolProbity stand-in shared by the benchmarks: replays captured (or
+synthetic) tool outputs instead of running the tools.
+"""
+
+import functools
+import io
+import os
+import random
+import string
+import time
+from typing import Iterator
+
+TOOLS = ("residue-analysis", "clashscore")
+
+HEADER = (
+    "residue,worst_clash,src_atom,dst_atom,dst_residue,num_length_out,"
+    "worst_length,worst_length_value,worst_length_sigma,num_angle_out,"
+    "worst_angle,worst_angle_value,worst_angle_sigma,omega,omega_eval,"
+    "rama_eval,rotamer_eval,rotamer"
+)
+
+# average length of an ATOM record, used to estimate the atoms of a model
+PDB_RECORD_BYTES = 81
+
+
+def synthetic_output(residues: int) -> bytes:
+    """Residue-analysis output with roughly a third of residues flagged"""
+    rng = random.Random(0)
+    types = ["ALA", "ARG", "GLY", "LYS", "LEU", "TYR"]
+
+    def residue(i: int) -> str:
+        # unique residues, as in real outputs
+        chain = string.ascii_letters[i // 9999]
+        number = i % 9999 + 1
+        type = types[i % len(types)]
+        if number >= 1000:
+            return f"{chain}{number:4d} {type}"
+        return f"{chain} {number:4d}  {type}"
+
+    rows = [HEADER]
+    for i in range(residues):
+        row = [residue(i)] + [""] * 17
+        if rng.random() < 0.3:
+            row[1:5] = [f"{rng.uniform(0.4, 2):.3f}", " CA ", " O  ", residue(i + 1)]
+        if rng.random() < 0.1:
+            row[5:9] = ["1", "CA--C", f"{rng.uniform(1.3, 1.7):.3f}", "4.5"]
+        if rng.random() < 0.1:
+            row[9:13] = ["1", "N-CA-C", f"{rng.uniform(100, 125):.1f}", "5.2"]
+        if rng.random() < 0.1:
+            row[13:15] = [f"{rng.uniform(-180, 180):.1f}", "Twisted"]
+        if rng.random() < 0.2:
+            row[15] = rng.choice(["Allowed", "OUTLIER"])
+        if rng.random() < 0.1:
+            row[16:18] = ["OUTLIER", "mtmt"]
+        rows.append(",".join(row))
+
+    return ("\n".join(rows) + "\n").encode("utf-8")
+
+
+def _clash_atom(chain: str, number: int, residue: str, atom: str) -> str:
+    """
+    Fixed-width atom of a clash line: chain, residue number, insertion code,
+    residue name, atom name and altloc, e.g. " A  72  ARG  HG2 "
+    """
+    return f"{chain:>2}{number:4d}  {residue:3} {atom:4} "
+
+
+def synthetic_clashscore(atoms: int) -> bytes:
+    """Clashscore output with a clash for every 20th atom"""
+    rng = random.Random(0)
+    lines = [
+        "Using electron cloud x-H distances and vdW radii.",
+        "",
+        "Adding H/D atoms with reduce (hydrogen addition may take a while)...",
+        "Bad Clashes >= 0.4 Angstrom:",
+        "",
+    ]
+    for i in range(atoms // 20):
+        chain = string.ascii_uppercase[i // 9999 % 26]
+        first = _clash_atom(chain, i % 9999 + 1, "LYS", " HG2")
+        second = _clash_atom(chain, (i + 7) % 9999 + 1, "ASP", " OD1")
+        lines.append(f"{first}{second}:{rng.uniform(0.4, 1.5):.3f}")
+    lines.append("")
+    lines.append(f"clashscore = {rng.uniform(0, 40):.2f}")
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class ReplayEngine:
+    """
+    Replays `outputs` of the tools, keyed by the tool name. Tools without an
+    output get a synthetic one sized after the model. A run sleeps
+    `delay + delay_per_atom * atoms`, where the atoms are estimated from the
+    size of the model file.
+    """
+
+    def __init__(
+        self,
+        outputs: dict[str, bytes] | None = None,
+        delay: float = 0,
+        delay_per_atom: float = 0,
+    ) -> None:
+        self.outputs = outputs if outputs is not None else {}
+        self.delay = delay
+        self.delay_per_atom = delay_per_atom
+
+    @staticmethod
+    def from_recordings(
+        directory: str, delay: float = 0, delay_per_atom: float = 0
+    ) -> "ReplayEngine":
+        """Replays the <tool>.out files of `directory`"""
+        outputs = {}
+        for tool in TOOLS:
+            with open(os.path.join(directory, f"{tool}.out"), "rb") as file:
+                outputs[tool] = file.read()
+
+        return ReplayEngine(outputs, delay, delay_per_atom)
+
+    @staticmethod
+    def _atoms(path: str) -> int:
+        return os.path.getsize(path) // PDB_RECORD_BYTES
+
+    @functools.lru_cache(maxsize=64)
+    def _synthetic(self, tool: str, atoms: int) -> bytes:
+        if tool == "clashscore":
+            return synthetic_clashscore(atoms)
+        # five atoms per residue, see e2e_benchmark.synthetic_pdb
+        return synthetic_output(max(atoms // 5, 1))
+
+    def stream(self, args: list[str], timeout: float) -> Iterator[str]:
+        tool, path = args
+        if self.delay or self.delay_per_atom:
+            time.sleep(self.delay + self.delay_per_atom * self._atoms(path))
+
+        if tool in self.outputs:
+            output = self.outputs[tool]
+        else:
+            output = self._synthetic(tool, self._atoms(path))
+        return io.StringIO(output.decode("utf-8"))
@@ -0,0 +1,211 @@
+import hashlib
+import io
+import os
+import threading
+from typing import Protocol
+
+from structlog import get_logger
+import minio
+from minio.error import S3Error
+
+from sqc.repository import mask_minio_action
+from sqc.validation.model import RESULT_SCHEMA_VERSION, MolProbityVersions
+from sqc.workspace import scratch_root
+
+logger = get_logger()
+
+
+def cache_key(path: str, ftype: str, versions: MolProbityVersions) -> str:
+    """
+    Computes the cache key of a request from its normalized content, the
+    MolProbity data versions and the result schema version, so that results
+    are invalidated whenever the data repositories or the output change.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"schema-{RESULT_SCHEMA_VERSION}".encode("utf-8"))
+    digest.update(ftype.lower().encode("utf-8"))
+    digest.update(versions.model_dump_json().encode("utf-8"))
+
+    # normalize line endings and trailing whitespace
+    with open(path, "rb") as file:
+        for line in file:
+            digest.update(line.rstrip())
+            digest.update(b"\n")
+
+    return digest.hexdigest()
+
+
+class ResultCache(Protocol):
+    def get(self, key: str) -> str | None: ...
+
+    def put(self, key: str, result: str) -> None: ...
+
+
+class LocalResultCache:
+    """On-disk result cache evicting the least recently used entries"""
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _entries(self) -> list[tuple[float, str, int]]:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        return entries
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            with open(path, "r") as file:
+                result = file.read()
+            # mtime marks the last use of the entry
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return result
+
+    def put(self, key: str, result: str) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(result)
+
+        size = os.path.getsize(tmp_path)
+
+        with self._lock:
+            # an entry written again replaces the previous one
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            logger.debug("Evicted cached result", path=path)
+
+
+class MinioResultCache:
+    """Result cache shared across replicas through a MinIO bucket"""
+
+    def __init__(self, minio: minio.Minio, bucket: str = "cache") -> None:
+        self.minio = minio
+        self.bucket = bucket
+
+        if not self.minio.bucket_exists(self.bucket):
+            logger.info(f"Creating bucket {self.bucket}")
+            self.minio.make_bucket(self.bucket)
+
+    def get(self, key: str) -> str | None:
+        try:
+            response = self.minio.get_object(self.bucket, f"{key}.json")
+        except S3Error as err:
+            if err.code != "NoSuchKey":
+                logger.warning("Failed to fetch cached result", error=err.code)
+            return None
+        except Exception:
+            logger.warning("Failed to fetch cached result", exc_info=True)
+            return None
+
+        try:
+            return response.data.decode("utf-8")
+        finally:
+            response.close()
+            response.release_conn()
+
+    @mask_minio_action("put_cached_result", raise_error=False)
+    def put(self, key: str, result: str) -> None:
+        body = result.encode("utf-8")
+        self.minio.put_object(self.bucket, f"{key}.json", io.BytesIO(body), len(body))
+
+
+class TieredResultCache:
+    """Looks results up in the given caches in order, filling the earlier ones"""
+
+    def __init__(self, caches: list[ResultCache]) -> None:
+        self.caches = caches
+
+    def get(self, key: str) -> str | None:
+        for i, cache in enumerate(self.caches):
+            result = cache.get(key)
+            if result is not None:
+                for upper in self.caches[:i]:
+                    try:
+                        upper.put(key, result)
+                    except OSError:
+                        # a full or read-only disk must not fail the hit
+                        logger.exception("Failed to fill result cache", key=key)
+                return result
+
+        return None
+
+    def put(self, key: str, result: str) -> None:
+        for cache in self.caches:
+            cache.put(key, result)
+
+
+def create_result_cache(minio: minio.Minio) -> ResultCache | None:
+    """
+    Creates the result cache configured by the RESULT_CACHE environment
+    variable, a comma separated list of backends ("local", "minio"). The
+    local cache lives in RESULT_CACHE_DIR, by default next to the request
+    workspaces in the scratch directory.
+    """
+    backends = [
+        backend.strip()
+        for backend in os.environ.get("RESULT_CACHE", "").split(",")
+        if backend.strip()
+    ]
+
+    caches: list[ResultCache] = []
+    for backend in backends:
+        if backend == "local":
+            caches.append(
+                LocalResultCache(
+                    os.environ.get(
+                        "RESULT_CACHE_DIR", os.path.join(scratch_root(), "result-cache")
+                    ),
+                    int(os.environ.get("RESULT_CACHE_MAX_BYTES", 1024**3)),
+                )
+            )
+        elif backend == "minio":
+            caches.append(MinioResultCache(minio))
+        else:
+            raise ValueError(f"Unknown result cache backend: {backend}")
+
+    if not caches:
+        return None
+
+    logger.info("Using result cache", backends=backends)
+    return caches[0] if len(caches) == 1 else TieredResultCache(caches)
@@ -0,0 +1,116 @@
+import os
+from typing import Any
+
+from structlog import get_logger
+import structlog
+from kombu import Exchange, Producer, Queue
+from kombu.mixins import ConsumerMixin
+
+from sqc.repository import MinioRepo
+from sqc.worker import Worker, rabbit_connection
+
+logger = get_logger()
+
+LANES = ("priority", "small", "large")
+
+lane_exchange = Exchange("requests.lanes", type="direct", durable=True)
+
+# rough size of a single atom record, used to estimate the atom count
+BYTES_PER_ATOM = {"pdb": 81, "cif": 90, "mmcif": 90}
+
+
+def lane_queue(lane: str) -> Queue:
+    return Queue(f"requests.{lane}", lane_exchange, routing_key=lane)
+
+
+def parse_lanes(raw: str) -> dict[str, int]:
+    """Parses the LANES configuration, e.g. "priority=1,small=2,large=1" """
+    lanes = {}
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+
+        lane, workers = item.split("=")
+        if lane.strip() not in LANES:
+            raise ValueError(f"Unknown lane: {lane}")
+        lanes[lane.strip()] = int(workers)
+
+    return lanes
+
+
+def classify(
+    size: int, ftype: str | None, priority: str | None, large_atoms: int
+) -> str:
+    """Selects the lane of a request from its size and client priority"""
+    if priority is not None and priority.lower() in {"high", "priority"}:
+        return "priority"
+
+    atoms = size // BYTES_PER_ATOM.get((ftype or "").lower(), 81)
+    return "large" if atoms >= large_atoms else "small"
+
+
+class Router(ConsumerMixin):
+    """
+    Consumes the requests queue and routes each request to the queue of its
+    lane, so that large structures do not hold up small ones
+    """
+
+    def __init__(self, repo: MinioRepo, lanes: set[str]) -> None:
+        self.connection = rabbit_connection()
+        self.repo = repo
+        self.lanes = lanes
+        self.large_atoms = int(os.environ.get("LARGE_LANE_ATOMS", 50_000))
+        self.default_lane = "small" if "small" in lanes else next(iter(lanes))
+
+    def get_consumers(self, consumer, _):
+        return [
+            consumer(
+                queues=[Worker.queue], callbacks=[self.on_message], prefetch_count=16
+            )
+        ]
+
+    def _lane(self, request: str) -> str:
+        try:
+            size, ftype, priority = self.repo.stat_request(request)
+        except Exception:
+            # let the worker report the failure to the client
+            logger.warning("Failed to classify request")
+            return self.default_lane
+
+        lane = classify(size, ftype, priority, self.large_atoms)
+        if lane not in self.lanes:
+            # no workers are dedicated to the lane
+            lane = self.default_lane
+
+        return lane
+
+    def on_message(self, body: dict[str, Any], message) -> None:
+        structlog.contextvars.clear_contextvars()
+
+        lane = self.default_lane
+        try:
+            request = body["Records"][0]["s3"]["object"]["key"]
+            structlog.contextvars.bind_contextvars(request_id=request)
+            lane = self._lane(request)
+        except (KeyError, IndexError):
+            # invalid messages are dropped by the worker
+            pass
+
+        logger.info("Routing request", lane=lane)
+        Producer(message.channel).publish(
+            body,
+            exchange=lane_exchange,
+            routing_key=lane,
+            declare=[lane_queue(lane)],
+            serializer="json",
+        )
+        message.ack()
+
+    def run(self, *args, **kwargs) -> None:
+        while not self.should_stop:
+            try:
+                super().run(*args, **kwargs)
+            except Exception:
+                logger.exception("Router shut down because of an exception")
+
+        self.connection.release()
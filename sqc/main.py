@@ -1,15 +1,22 @@
+import multiprocessing
 import os
 import threading
-from time import sleep
+from time import monotonic, sleep
 import signal
 
 from structlog import get_logger
 import minio
 
-from sqc.repository import MinioRepo
+from sqc.cache import create_result_cache
+from sqc.lanes import Router, lane_queue, parse_lanes
+from sqc.metrics import start_metrics_server
+from sqc.repository import MinioRepo, minio_http_client
+from sqc.validation.versions import molprobity_versions
 from sqc.worker import Worker
+from sqc.workspace import sweep_orphaned_workspaces
 
 SHOULD_STOP = False
+SHOULD_REFRESH_VERSIONS = False
 
 logger = get_logger()
 
@@ -19,35 +26,79 @@ def handler(_, __) -> None:
     SHOULD_STOP = True
 
 
-def main() -> None:
+def refresh_handler(_, __) -> None:
+    global SHOULD_REFRESH_VERSIONS
+    SHOULD_REFRESH_VERSIONS = True
+
+
+def run_workers(index: int = 0) -> None:
+    """
+    Runs NTHREADS worker threads in the current process, `index` is the
+    number of the worker process
+    """
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGHUP, refresh_handler)
+    # blocked by the supervisor until the handler is installed, see supervise
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGHUP})
+
+    start_metrics_server(index)
+
+    # workspaces of crashed workers, including earlier runs of this process
+    sweep_orphaned_workspaces()
+
+    # loaded once, shared by all workers
+    molprobity_versions.get()
+    versions_check_interval = int(os.environ.get("VERSIONS_CHECK_INTERVAL", 60))
+    last_versions_check = monotonic()
+
+    lanes = parse_lanes(os.environ.get("LANES", ""))
+    nthreads = int(os.environ.get("NTHREADS", 1))
+    nworkers = sum(lanes.values()) + 1 if lanes else nthreads
 
     minio_conn = minio.Minio(
         endpoint=os.environ["MINIO_URL"].strip('"'),
         access_key=os.environ.get("MINIO_USER", "minioadmin"),
         secret_key=os.environ.get("MINIO_PASSWORD", "minioadmin"),
         secure=False,
+        http_client=minio_http_client(minio_pool_size(nworkers)),
     )
 
     repo = MinioRepo(minio_conn)
+    cache = create_result_cache(minio_conn)
 
-    nthreads = int(os.environ.get("NTHREADS", 1))
     threads: list[threading.Thread] = []
-    workers: list[Worker] = []
-
-    for _ in range(nthreads):
-        worker = Worker(repo)
-        workers.append(worker)
-
+    workers: list[Worker | Router] = []
+
+    if lanes:
+        workers.append(Router(repo, set(lanes)))
+        for lane, nworkers in lanes.items():
+            for _ in range(nworkers):
+                workers.append(Worker(repo, cache, lane_queue(lane)))
+    else:
+        for _ in range(nthreads):
+            workers.append(Worker(repo, cache))
+
+    for i, worker in enumerate(workers):
         logger.info("Starting worker")
-        t = threading.Thread(target=worker.run, args=[])
+        # names the in-flight requests gauge of the worker
+        t = threading.Thread(target=worker.run, args=[], name=f"worker-{i}")
         threads.append(t)
         t.start()
 
-    global SHOULD_STOP
+    global SHOULD_STOP, SHOULD_REFRESH_VERSIONS
     while True:
         sleep(1)  # TODO: smaller period
+        if SHOULD_REFRESH_VERSIONS:
+            SHOULD_REFRESH_VERSIONS = False
+            molprobity_versions.refresh()
+        elif (
+            versions_check_interval > 0
+            and monotonic() - last_versions_check >= versions_check_interval
+        ):
+            last_versions_check = monotonic()
+            molprobity_versions.refresh_if_changed()
+
         for thread in threads:
             if not thread.is_alive():
                 SHOULD_STOP = True
@@ -64,5 +115,111 @@ def main() -> None:
             exit(1)
 
 
+def minio_pool_size(nworkers: int) -> int:
+    """Connections for all threads of the process to use MinIO at once"""
+    if (size := os.environ.get("MINIO_POOL_SIZE")) is not None:
+        return int(size)
+
+    threads_per_worker = 1
+    if os.environ.get("PIPELINE", "off") == "on":
+        # only the fetch and upload stages talk to MinIO
+        threads_per_worker = Worker._stage_threads("FETCH") + Worker._stage_threads(
+            "UPLOAD"
+        )
+
+    # plus the result cache
+    return max(nworkers * threads_per_worker + 1, 10)
+
+
+def worker_processes(nthreads: int) -> int:
+    """Number of worker processes to supervise, 0 runs the workers in-process"""
+    nprocs = os.environ.get("WORKER_PROCESSES", "0")
+    if nprocs == "auto":
+        return max((os.cpu_count() or 1) // nthreads, 1)
+
+    return int(nprocs)
+
+
+def supervise(nprocs: int) -> None:
+    """
+    Runs `nprocs` worker processes, restarting the ones that die with an
+    exponential backoff. SIGTERM and SIGINT are propagated to the workers,
+    which finish their current requests before exiting.
+    """
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGHUP, refresh_handler)
+
+    backoff_base = float(os.environ.get("RESTART_BACKOFF", 1))
+    backoff_max = float(os.environ.get("RESTART_BACKOFF_MAX", 60))
+    # a worker running for this long is considered healthy again
+    stable_after = 60
+
+    ctx = multiprocessing.get_context("spawn")
+    procs: list[multiprocessing.process.BaseProcess | None] = [None] * nprocs
+    started = [0.0] * nprocs
+    failures = [0] * nprocs
+    restart_at = [0.0] * nprocs
+
+    global SHOULD_REFRESH_VERSIONS
+    while not SHOULD_STOP:
+        if SHOULD_REFRESH_VERSIONS:
+            SHOULD_REFRESH_VERSIONS = False
+            for proc in procs:
+                if proc is not None and proc.pid is not None:
+                    os.kill(proc.pid, signal.SIGHUP)
+
+        for i in range(nprocs):
+            proc = procs[i]
+            if proc is not None and not proc.is_alive():
+                if monotonic() - started[i] >= stable_after:
+                    failures[i] = 0
+                delay = min(backoff_base * 2 ** failures[i], backoff_max)
+                failures[i] += 1
+                restart_at[i] = monotonic() + delay
+
+                logger.error(
+                    "Worker process died, restarting",
+                    exitcode=proc.exitcode,
+                    delay=delay,
+                )
+                procs[i] = None
+
+            if procs[i] is None and monotonic() >= restart_at[i]:
+                logger.info("Starting worker process")
+                proc = ctx.Process(target=run_workers, args=[i], name=f"sqc-worker-{i}")
+                # the default action of SIGHUP terminates the process, the
+                # worker starts with it blocked and unblocks it once it has
+                # installed its handler, a reload meanwhile stays pending
+                mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGHUP})
+                try:
+                    proc.start()
+                finally:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+                procs[i] = proc
+                started[i] = monotonic()
+
+        sleep(0.5)
+
+    logger.warning("Stopping all worker processes")
+    for proc in procs:
+        if proc is not None and proc.is_alive():
+            proc.terminate()
+
+    for proc in procs:
+        if proc is not None:
+            proc.join()
+
+
+def main() -> None:
+    nthreads = int(os.environ.get("NTHREADS", 1))
+    nprocs = worker_processes(nthreads)
+
+    if nprocs > 0:
+        supervise(nprocs)
+    else:
+        run_workers()
+
+
 if __name__ == "__main__":
     main()
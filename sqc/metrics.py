@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+from time import perf_counter
+from typing import Iterator
+
+from structlog import get_logger
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = get_logger()
+
+# from sub-second conversions up to the default MolProbity timeout
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "sqc_stage_seconds",
+    "Time spent in a stage of request processing",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS = Counter("sqc_requests", "Processed requests by their outcome", ["outcome"])
+TOOL_TIMEOUTS = Counter(
+    "sqc_tool_timeouts", "MolProbity tool runs that did not finish in time", ["tool"]
+)
+TOOL_TIMEOUT_SECONDS = Histogram(
+    "sqc_tool_timeout_seconds",
+    "Timeouts applied to MolProbity tool runs",
+    ["tool"],
+    buckets=(30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600),
+)
+DEDUP_SAVED_INVOCATIONS = Counter(
+    "sqc_dedup_saved_invocations",
+    "MolProbity tool runs saved by reusing the results of duplicate models",
+)
+IN_FLIGHT = Gauge(
+    "sqc_in_flight_requests", "Requests being processed by a worker", ["worker"]
+)
+
+MINIO_ACTION_SECONDS = Histogram(
+    "sqc_minio_action_seconds",
+    "Duration of MinIO actions including retries",
+    ["action"],
+    buckets=STAGE_BUCKETS,
+)
+MINIO_RETRIES = Counter("sqc_minio_retries", "Retried MinIO calls", ["action"])
+MINIO_FAILURES = Counter(
+    "sqc_minio_failures", "MinIO actions that failed after retrying", ["action"]
+)
+MINIO_REJECTED = Counter(
+    "sqc_minio_rejected", "MinIO actions rejected by the circuit breaker", ["action"]
+)
+
+WORKSPACE_BYTES = Histogram(
+    "sqc_workspace_bytes",
+    "Size of request workspaces when they are removed",
+    buckets=(2**16, 2**18, 2**20, 2**22, 2**24, 2**26, 2**28, 2**30),
+)
+SCRATCH_FREE_BYTES = Gauge(
+    "sqc_scratch_free_bytes", "Free space of the scratch filesystem"
+)
+
+
+class RequestTimings:
+    """
+    Seconds a single request spent in each stage. Stages that run several
+    times, e.g. residue-analysis of each model, are summed up.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            return {stage: round(s, 3) for stage, s in self._stages.items()}
+
+
+_timings: ContextVar[RequestTimings | None] = ContextVar("timings", default=None)
+
+
+@contextmanager
+def collect_timings(timings: RequestTimings) -> Iterator[None]:
+    """Records the stages timed in this context into `timings`"""
+    token = _timings.set(timings)
+    try:
+        yield
+    finally:
+        _timings.reset(token)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    if (timings := _timings.get()) is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Times a stage, usable as a context manager or a decorator"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, perf_counter() - start)
+
+
+def start_metrics_server(offset: int = 0) -> None:
+    """
+    Serves the metrics on METRICS_PORT + `offset`, every worker process gets
+    its own port. Nothing is served when METRICS_PORT is not set.
+    """
+    port = os.environ.get("METRICS_PORT")
+    if not port:
+        return
+
+    address = os.environ.get("METRICS_ADDRESS", "127.0.0.1")
+    prometheus_client.start_http_server(int(port) + offset, addr=address)
+    logger.info("Serving metrics", address=address, port=int(port) + offset)
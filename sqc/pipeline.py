@@ -0,0 +1,125 @@
+from dataclasses import dataclass, field
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Callable
+
+from structlog import get_logger
+import structlog
+
+from sqc.metrics import RequestTimings
+from sqc.repository import SQCResponse
+from sqc.workspace import Workspace
+
+logger = get_logger()
+
+
+@dataclass
+class Job:
+    """State of a single request as it passes through the worker stages"""
+
+    request: str
+    message: Any
+    path: str | None = None
+    ftype: str | None = None
+    filename: str | None = None
+    cache_key: str | None = None
+    response: SQCResponse | None = None
+    cacheable: bool = False
+    written: bool = False
+    workspace: Workspace | None = None
+    # a partial result was written and is removed with the response
+    partial_written: bool = False
+    # storage was unavailable, the message goes back to the queue
+    retry_later: bool = False
+    # longest MolProbity timeout, reported with the response
+    applied_timeout: float | None = None
+    # reported in the metrics once the job is finished
+    outcome: str = "ok"
+    started: float = field(default_factory=perf_counter)
+    timings: RequestTimings = field(default_factory=RequestTimings)
+
+
+@dataclass
+class Stage:
+    name: str
+    concurrency: int
+    run: Callable[[Job], None]
+
+
+class _Stop:
+    pass
+
+
+_STOP = _Stop()
+
+
+class Pipeline:
+    """
+    Runs jobs through a sequence of stages connected by bounded queues. Each
+    stage has its own threads, so e.g. uploads of finished requests overlap
+    with the validation of the next ones. Finished jobs are collected in
+    `completed`.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 1) -> None:
+        self.stages = stages
+        self.completed: queue.Queue[Job] = queue.Queue()
+        self._queues: list[queue.Queue[Job | _Stop]] = [
+            queue.Queue(maxsize=queue_size) for _ in stages
+        ]
+        self._threads: list[list[threading.Thread]] = []
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+        for i, stage in enumerate(stages):
+            threads = []
+            for n in range(stage.concurrency):
+                thread = threading.Thread(
+                    target=self._run_stage,
+                    args=[i],
+                    name=f"pipeline-{stage.name}-{n}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+            self._threads.append(threads)
+
+    def _run_stage(self, i: int) -> None:
+        stage = self.stages[i]
+        inbox = self._queues[i]
+        last = i == len(self.stages) - 1
+
+        while not isinstance(job := inbox.get(), _Stop):
+            with structlog.contextvars.bound_contextvars(request_id=job.request):
+                try:
+                    stage.run(job)
+                except Exception:
+                    logger.exception("Pipeline stage failed", stage=stage.name)
+
+            if last:
+                self.completed.put(job)
+                with self._idle:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+            else:
+                self._queues[i + 1].put(job)
+
+    def submit(self, job: Job) -> None:
+        """Queues a job, blocks while the first stage is full"""
+        with self._idle:
+            self._in_flight += 1
+        self._queues[0].put(job)
+
+    def join(self) -> None:
+        """Waits until all submitted jobs are completed"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0)
+
+    def close(self) -> None:
+        """Finishes the queued jobs and stops the stage threads"""
+        for inbox, threads in zip(self._queues, self._threads):
+            for _ in threads:
+                inbox.put(_STOP)
+            for thread in threads:
+                thread.join()
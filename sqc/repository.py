@@ -1,13 +1,28 @@
 import json
 import io
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Callable, Iterator
 import functools
+import os
 import subprocess
+import zlib
+from time import perf_counter, sleep
 
 from structlog import get_logger
+import gemmi
 import minio
+from minio.error import S3Error, ServerError
 from minio.notificationconfig import QueueConfig, NotificationConfig
+import urllib3
+
+from sqc.metrics import (
+    MINIO_ACTION_SECONDS,
+    MINIO_FAILURES,
+    MINIO_REJECTED,
+    MINIO_RETRIES,
+    timed,
+)
+from sqc.resilience import RetryPolicy, storage_breaker
 
 logger = get_logger()
 
@@ -16,15 +31,27 @@ logger = get_logger()
 class SQCResponse:
     error: str | None
     result: str | None
+    # serializes the result in chunks, called again when an upload is retried
+    chunks: Callable[[], Iterator[str]] | None = None
 
     @staticmethod
     def ok(result: str) -> "SQCResponse":
         return SQCResponse(None, result)
 
+    @staticmethod
+    def ok_stream(chunks: Callable[[], Iterator[str]]) -> "SQCResponse":
+        return SQCResponse(None, None, chunks)
+
     @staticmethod
     def err(msg: str) -> "SQCResponse":
         return SQCResponse(msg, None)
 
+    def result_chunks(self) -> Iterator[str]:
+        if self.chunks is not None:
+            yield from self.chunks()
+        elif self.result:
+            yield self.result
+
 
 class InternalError(Exception):
     def __init__(self, *args) -> None:
@@ -36,21 +63,88 @@ class ConversionError(Exception):
         super().__init__(*args)
 
 
+class StorageUnavailable(InternalError):
+    """MinIO is down, the request should be retried later"""
+
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+
+
+# S3 error codes worth retrying, other errors (e.g. NoSuchKey) are final
+RETRYABLE_S3_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+}
+
+
+def is_retryable(err: Exception) -> bool:
+    """Whether a failed MinIO call may succeed when repeated"""
+    if isinstance(err, S3Error):
+        return err.code in RETRYABLE_S3_CODES
+
+    # 5xx responses without an S3 error body, connection errors and timeouts
+    return isinstance(
+        err, (ServerError, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+    )
+
+
 def mask_minio_action(name: str, raise_error: bool = True):
+    """
+    Retries retryable errors of a MinIO action with exponential backoff and
+    trips the storage circuit breaker when they persist. Failures either
+    raise InternalError (StorageUnavailable when the breaker is open) or are
+    logged and turned into a None result.
+    """
+    policy = RetryPolicy.from_env()
+
     def wrapper(action):
         @functools.wraps(action)
         def inner(*args, **kwargs):
-            retries = 3
+            if not storage_breaker.allow():
+                MINIO_REJECTED.labels(name).inc()
+                logger.warning("MinIO is unavailable, skipping action", action=name)
+                if raise_error:
+                    raise StorageUnavailable()
+                return None
+
+            start = perf_counter()
+            retries = 0
             last_err = None
             result = None
-            while retries != 0:
+            while True:
                 try:
                     result = action(*args, **kwargs)
+                    last_err = None
+                    storage_breaker.record_success()
                     break
                 except Exception as err:
-                    logger.warning("Failed to execute minio action", action=name)
-                    retries -= 1
                     last_err = err
+                    if not is_retryable(err):
+                        # MinIO answered, the storage itself is fine
+                        storage_breaker.record_success()
+                        break
+
+                    if retries + 1 >= policy.attempts:
+                        storage_breaker.record_failure()
+                        break
+
+                    delay = policy.delay(retries)
+                    logger.warning(
+                        "Failed to execute minio action, retrying",
+                        action=name,
+                        error=repr(err),
+                        delay=delay,
+                    )
+                    retries += 1
+                    sleep(delay)
+
+            latency = perf_counter() - start
+            MINIO_ACTION_SECONDS.labels(name).observe(latency)
+            MINIO_RETRIES.labels(name).inc(retries)
+            if last_err:
+                MINIO_FAILURES.labels(name).inc()
 
             if last_err:
                 # try/except hack to make structlog log the traceback
@@ -58,10 +152,12 @@ def mask_minio_action(name: str, raise_error: bool = True):
                     raise last_err
                 except Exception as err:
                     logger.exception(
-                        f"Failed to execute minio after retrying", action=name
+                        f"Failed to execute minio action", action=name, retries=retries
                     )
 
                 if raise_error:
+                    if storage_breaker.is_open():
+                        raise StorageUnavailable() from last_err
                     raise InternalError from last_err
 
             return result
@@ -71,6 +167,91 @@ def mask_minio_action(name: str, raise_error: bool = True):
     return wrapper
 
 
+def minio_http_client(pool_size: int) -> urllib3.PoolManager:
+    """
+    HTTP client of the MinIO connection with `pool_size` connections, enough
+    for all threads of the process to talk to MinIO at once. Retries are left
+    to mask_minio_action.
+    """
+    timeout = float(os.environ.get("MINIO_TIMEOUT", 60))
+    return urllib3.PoolManager(
+        num_pools=2,
+        maxsize=pool_size,
+        timeout=urllib3.Timeout(connect=min(timeout, 10), read=timeout),
+        retries=urllib3.Retry(total=0, connect=0, read=0, redirect=0, status=0),
+    )
+
+
+RESPONSE_ENCODINGS = ("identity", "gzip", "zstd")
+
+DOWNLOAD_CHUNK_SIZE = 2**20
+
+# object name suffix of partial results, written next to <request>.json
+PARTIAL_SUFFIX = ".partial.json"
+
+# serialized JSON is encoded (and compressed) in batches of this many bytes
+ENCODE_BATCH_SIZE = 64 * 1024
+
+
+def _compressor(encoding: str) -> Any:
+    if encoding == "gzip":
+        # wbits=31 writes the gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    try:
+        import zstandard  # type: ignore[import-not-found]
+    except ImportError:
+        raise ValueError("RESPONSE_ENCODING=zstd requires the zstandard package")
+
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def _encode(chunks: Iterator[str], encoding: str) -> Iterator[bytes]:
+    """Encodes the JSON chunks to UTF-8 and compresses them with `encoding`"""
+    compressor = _compressor(encoding) if encoding != "identity" else None
+
+    def encoded(batch: list[str]) -> bytes:
+        data = "".join(batch).encode("utf-8")
+        return compressor.compress(data) if compressor is not None else data
+
+    batch: list[str] = []
+    batch_size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        batch_size += len(chunk)
+        if batch_size >= ENCODE_BATCH_SIZE:
+            yield encoded(batch)
+            batch.clear()
+            batch_size = 0
+
+    if batch:
+        yield encoded(batch)
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class _ChunkReader:
+    """File-like reader over an iterator of byte chunks, as put_object expects"""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
 class MinioRepo:
     request_bucket = "requests"
     result_bucket = "results"
@@ -78,6 +259,19 @@ class MinioRepo:
     def __init__(self, minio: minio.Minio):
         self.minio = minio
 
+        # compression of successful responses, signalled by Content-Encoding
+        self.response_encoding = os.environ.get("RESPONSE_ENCODING", "identity")
+        if self.response_encoding not in RESPONSE_ENCODINGS:
+            raise ValueError(f"Unknown response encoding: {self.response_encoding}")
+        if self.response_encoding != "identity":
+            _compressor(self.response_encoding)
+
+        # responses larger than a part are uploaded as multipart uploads,
+        # minio requires parts of at least 5 MiB
+        self.response_part_size = max(
+            int(os.environ.get("RESPONSE_PART_SIZE", 5 * 2**20)), 5 * 2**20
+        )
+
         self._ensure_bucket(self.request_bucket)
         self._ensure_bucket(self.result_bucket)
 
@@ -102,10 +296,7 @@ class MinioRepo:
             logger.info(f"Bucket {bucket} already exists")
 
     @staticmethod
-    def _convert_to_pdb(path: str) -> str:
-        new_path = f"{path.split('.')[0]}.pdb"
-        logger.debug(f"Converting {path} to PDB format")
-
+    def _convert_with_cli(path: str, new_path: str) -> None:
         try:
             proc = subprocess.run(
                 ["gemmi", "convert", path, new_path], capture_output=True, timeout=60
@@ -122,64 +313,175 @@ class MinioRepo:
             )
             raise ConversionError("Failed to convert .mmcif file to PDB format")
 
+    @staticmethod
+    def _convert_in_process(path: str, new_path: str) -> None:
+        # gemmi reads the file in its C++ reader, no Python-side copy is made
+        structure = gemmi.read_structure(path)
+        structure.write_pdb(new_path)
+
+    @staticmethod
+    @timed("convert_to_pdb")
+    def _convert_to_pdb(path: str) -> str:
+        new_path = f"{os.path.splitext(path)[0]}.pdb"
+        logger.debug(f"Converting {path} to PDB format")
+
+        start = perf_counter()
+        engine = os.environ.get("CONVERSION_ENGINE", "gemmi")
+        if engine == "gemmi":
+            try:
+                MinioRepo._convert_in_process(path, new_path)
+            except Exception:
+                logger.warning(
+                    "In-process conversion failed, falling back to gemmi CLI",
+                    exc_info=True,
+                )
+                engine = "cli"
+
+        if engine == "cli":
+            MinioRepo._convert_with_cli(path, new_path)
+
+        logger.info(
+            "Converted request to PDB format",
+            engine=engine,
+            conversion_time=perf_counter() - start,
+        )
         return new_path
 
-    def download_request(self, request: str) -> tuple[str, str]:
-        path, ftype, filename = self._download_request(request)
+    @staticmethod
+    def ensure_pdb(path: str, ftype: str) -> str:
+        """Converts the request file to PDB format if it is not in it already"""
         if ftype != "pdb":
-            path = MinioRepo._convert_to_pdb(path)
+            return MinioRepo._convert_to_pdb(path)
 
-        return path, filename
+        return path
 
-    @mask_minio_action("download_request")
-    def _download_request(self, request: str) -> tuple[str, str, str]:
-        stat = self.minio.stat_object(self.request_bucket, request)
-        if not stat.metadata:
-            logger.error(f"Request does not contain metadata")
-            raise InternalError()
+    def fetch_request(self, request: str, directory: str) -> tuple[str, str, str]:
+        """Downloads the request file into `directory` without converting it"""
+        return self._download_request(request, directory)
 
-        ftype = stat.metadata.get("X-Amz-Meta-Ftype")
-        if not ftype:
-            logger.error(f"Request does not contain file type")
-            raise InternalError()
+    @timed("download_request")
+    @mask_minio_action("download_request")
+    def _download_request(self, request: str, directory: str) -> tuple[str, str, str]:
+        """
+        Streams the request object into `directory`, usually a request
+        workspace. The metadata comes with the response headers of the GET.
+        """
+        response = self.minio.get_object(self.request_bucket, request)
+        try:
+            metadata = {
+                key: value
+                for key, value in response.headers.items()
+                if key.lower().startswith("x-amz-meta-")
+            }
+
+            ftype = response.headers.get("X-Amz-Meta-Ftype")
+            if not ftype:
+                logger.error(f"Request does not contain file type")
+                raise InternalError()
+
+            filename = response.headers.get("X-Amz-Meta-Filename", "unknown")
+            path = os.path.join(directory, f"{request.replace('/', '_')}.{ftype}")
+            with open(path, "wb") as file:
+                for chunk in response.stream(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+
+        logger.info("Fetched request", metadata=metadata)
+        return path, ftype, filename
 
-        filename = stat.metadata.get("X-Amz-Meta-Filename", "unknown")
-        path = f"{request}.{ftype}"
-        self.minio.fget_object(self.request_bucket, request, path)
+    @mask_minio_action("stat_request")
+    def stat_request(self, request: str) -> tuple[int, str | None, str | None]:
+        """Returns the size, file type and client priority of a request"""
+        stat = self.minio.stat_object(self.request_bucket, request)
+        metadata = stat.metadata or {}
 
-        logger.info("Fetched request", metadata=stat.metadata)
-        return path, ftype, filename
+        return (
+            stat.size or 0,
+            metadata.get("X-Amz-Meta-Ftype"),
+            metadata.get("X-Amz-Meta-Priority"),
+        )
 
     @mask_minio_action("delete_request", raise_error=False)
     def delete_request(self, request: str) -> None:
         logger.debug(f"Deleting request from Minio")
         self.minio.remove_object(self.request_bucket, request)
 
-    def write_response(self, request: str, response: SQCResponse) -> None:
+    @timed("write_response")
+    def write_response(
+        self,
+        request: str,
+        response: SQCResponse,
+        timings: dict[str, float] | None = None,
+        applied_timeout: float | None = None,
+    ) -> bool:
+        """
+        Writes the response to Minio, returns whether it succeeded. The result
+        is serialized, encoded and uploaded in parts, it never exists in memory
+        as a whole. `timings` of the request stages and the longest MolProbity
+        `applied_timeout` are added to the metadata.
+        """
         logger.info(f"Writing response to Minio")
 
         metadata = dict()
+        encoding = "identity"
+        if timings:
+            metadata["sqc-timings"] = json.dumps(timings, separators=(",", ":"))
+        if applied_timeout is not None:
+            metadata["sqc-applied-timeout"] = str(round(applied_timeout, 3))
         if response.error:
             metadata["sqc-error"] = response.error
-
-        if response.result:
-            body = response.result.encode("utf-8")
         else:
-            body = bytes()
+            encoding = self.response_encoding
+            if encoding != "identity":
+                metadata["Content-Encoding"] = encoding
+
+        def body() -> Iterator[bytes]:
+            return _encode(response.result_chunks(), encoding)
+
+        return self._write_response(f"{request}.json", body, metadata) is not None
+
+    @timed("write_partial")
+    def write_partial(self, request: str, chunks: Callable[[], Iterator[str]]) -> bool:
+        """
+        Writes a partial result of a request still being validated. It goes to
+        a separate object, so that the response object only ever holds the
+        complete result. Each write replaces the previous partial result.
+        """
+        logger.debug(f"Writing partial result to Minio")
+
+        metadata = {"sqc-partial": "true"}
+        if self.response_encoding != "identity":
+            metadata["Content-Encoding"] = self.response_encoding
+
+        def body() -> Iterator[bytes]:
+            return _encode(chunks(), self.response_encoding)
+
+        return (
+            self._write_response(f"{request}{PARTIAL_SUFFIX}", body, metadata)
+            is not None
+        )
 
-        self._write_response(f"{request}.json", body, metadata)
+    @mask_minio_action("delete_partial", raise_error=False)
+    def delete_partial(self, request: str) -> None:
+        logger.debug(f"Deleting partial result from Minio")
+        self.minio.remove_object(self.result_bucket, f"{request}{PARTIAL_SUFFIX}")
 
     @mask_minio_action("write_response", raise_error=False)
     def _write_response(
-        self, object_name: str, body: bytes, metadata: dict[Any, Any]
-    ) -> None:
-        stream = io.BytesIO(body)
-
+        self,
+        object_name: str,
+        body: Callable[[], Iterator[bytes]],
+        metadata: dict[Any, Any],
+    ) -> bool:
         logger.debug(f"Writing result to minio", metadata=metadata)
         self.minio.put_object(
             self.result_bucket,
             object_name,
-            stream,
-            len(body),
+            _ChunkReader(body()),
+            -1,
             metadata=metadata,
+            part_size=self.response_part_size,
         )
+        return True
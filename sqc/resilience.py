@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+import os
+import random
+import threading
+from time import monotonic, sleep
+from typing import Callable
+
+from structlog import get_logger
+
+logger = get_logger()
+
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter"""
+
+    attempts: int = 3
+    base_delay: float = 0.2
+    max_delay: float = 5.0
+
+    @staticmethod
+    def from_env() -> "RetryPolicy":
+        return RetryPolicy(
+            attempts=max(int(os.environ.get("MINIO_ATTEMPTS", 3)), 1),
+            base_delay=float(os.environ.get("MINIO_BACKOFF", 0.2)),
+            max_delay=float(os.environ.get("MINIO_BACKOFF_MAX", 5)),
+        )
+
+    def delay(self, retry: int) -> float:
+        """Seconds to wait before the `retry`-th retry (counted from 0)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing dependency. After `threshold` consecutive failed
+    calls the breaker opens and rejects calls for `reset_timeout` seconds,
+    then lets a single probe call through. The breaker closes again when the
+    probe succeeds.
+    """
+
+    def __init__(self, name: str, threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Returns whether a call may be made now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._probing or monotonic() - self._opened_at < self.reset_timeout:
+                return False
+
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit breaker closed", breaker=self.name)
+
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (
+                self._opened_at is None and self._failures >= self.threshold
+            ):
+                if self._opened_at is None:
+                    logger.error(
+                        "Circuit breaker opened",
+                        breaker=self.name,
+                        failures=self._failures,
+                    )
+                self._opened_at = monotonic()
+                self._probing = False
+
+    def wait(self, should_stop: Callable[[], bool], interval: float = 1.0) -> None:
+        """
+        Blocks while the breaker is open, until a probe call is due or
+        should_stop() returns true
+        """
+        while not should_stop():
+            with self._lock:
+                if self._opened_at is None or (
+                    not self._probing
+                    and monotonic() - self._opened_at >= self.reset_timeout
+                ):
+                    return
+            sleep(interval)
+
+
+# shared by all worker threads of the process
+storage_breaker = CircuitBreaker(
+    "minio",
+    threshold=int(os.environ.get("MINIO_BREAKER_THRESHOLD", 5)),
+    reset_timeout=float(os.environ.get("MINIO_BREAKER_RESET", 30)),
+)
@@ -1 +1 @@
-from .validation import ValidationError, validate
+from .validation import ValidationError, validate, validate_structure
@@ -0,0 +1,357 @@
+from array import array
+from dataclasses import dataclass
+import functools
+import json
+import math
+from typing import Callable, Iterator, NamedTuple
+
+from pydantic_core import to_json
+
+from sqc.validation.model import Status
+
+# Per-residue and per-clash results are kept as columns (struct of arrays)
+# instead of one pydantic model per row. They serialize to the same JSON as
+# `Result.model_dump_json(exclude_none=True)`, see sqc/validation/model.py.
+
+
+@functools.lru_cache(maxsize=65536)
+def _str(value: str) -> str:
+    if not isinstance(value, str):
+        raise TypeError(f"Expected a string, got {value!r}")
+
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _float(value: float) -> str:
+    if not math.isfinite(value):
+        # the models serialize infinities and NaN as null (ser_json_inf_nan)
+        return "null"
+
+    text = repr(value)
+    if "e" in text:
+        # pydantic formats exponents differently, e.g. "0.00001" for 1e-05
+        return to_json(value).decode("utf-8")
+
+    return text
+
+
+def _optional_str(key: str, value: str | None) -> str:
+    return "" if value is None else f',"{key}":{_str(value)}'
+
+
+# rows serialized per chunk when streaming the JSON
+CHUNK_ROWS = 1024
+
+
+def _iter_rows_json(row_json: Callable[[int], str], rows: int) -> Iterator[str]:
+    """Yields the JSON array of the rows in chunks of CHUNK_ROWS rows"""
+    yield "["
+    for start in range(0, rows, CHUNK_ROWS):
+        chunk = ",".join(
+            row_json(i) for i in range(start, min(start + CHUNK_ROWS, rows))
+        )
+        yield chunk if start == 0 else "," + chunk
+    yield "]"
+
+
+class ResidueId(NamedTuple):
+    number: int
+    chain: str
+    residue_type: str
+    alt_code: str | None
+
+
+class ClashAtom(NamedTuple):
+    residue_number: int
+    chain: str
+    atom: str
+    insertion_code: str | None = None
+
+
+class ResidueColumns:
+    """
+    Results of residue-analysis, one row per residue. Numeric columns of
+    optional fields hold placeholders where the field is absent.
+    """
+
+    def __init__(self) -> None:
+        self.number = array("q")
+        self.chain: list[str] = []
+        self.residue_type: list[str] = []
+        self.alt_code: list[str | None] = []
+
+        # worst clash, absent where clash_atom is None
+        self.clash_magnitude = array("d")
+        self.clash_atom: list[str | None] = []
+        self.clash_other_atom: list[str | None] = []
+        self.clash_other_residue: list[ResidueId | None] = []
+
+        # worst bond length, absent where length_outliers is -1
+        self.length_outliers = array("q")
+        self.length_atoms: list[tuple[str, str] | None] = []
+        self.length_value = array("d")
+        self.length_sigma = array("d")
+
+        # worst bond angle, absent where angle_outliers is -1
+        self.angle_outliers = array("q")
+        self.angle_atoms: list[tuple[str, str, str] | None] = []
+        self.angle_value = array("d")
+        self.angle_sigma = array("d")
+
+        # torsions, absent where their evaluation is None
+        self.omega_range: list[str | None] = []
+        self.omega_angle = array("d")
+        self.rama_range: list[str | None] = []
+        self.sidechain_range: list[str | None] = []
+        self.rotamer: list[str | None] = []
+
+    def __len__(self) -> int:
+        return len(self.number)
+
+    def append(
+        self,
+        residue: ResidueId,
+        worst_clash: tuple[float, str, str, ResidueId] | None = None,
+        worst_length: tuple[int, str, str, float, float] | None = None,
+        worst_angle: tuple[int, str, str, str, float, float] | None = None,
+        omega: tuple[str, float] | None = None,
+        rama: str | None = None,
+        sidechain: tuple[str, str] | None = None,
+    ) -> None:
+        self.number.append(residue.number)
+        self.chain.append(residue.chain)
+        self.residue_type.append(residue.residue_type)
+        self.alt_code.append(residue.alt_code)
+
+        if worst_clash is not None:
+            magnitude, atom, other_atom, other_residue = worst_clash
+            self.clash_magnitude.append(magnitude)
+            self.clash_atom.append(atom)
+            self.clash_other_atom.append(other_atom)
+            self.clash_other_residue.append(other_residue)
+        else:
+            self.clash_magnitude.append(0.0)
+            self.clash_atom.append(None)
+            self.clash_other_atom.append(None)
+            self.clash_other_residue.append(None)
+
+        if worst_length is not None:
+            outliers, first_atom, second_atom, length, sigma = worst_length
+            self.length_outliers.append(outliers)
+            self.length_atoms.append((first_atom, second_atom))
+            self.length_value.append(length)
+            self.length_sigma.append(sigma)
+        else:
+            self.length_outliers.append(-1)
+            self.length_atoms.append(None)
+            self.length_value.append(0.0)
+            self.length_sigma.append(0.0)
+
+        if worst_angle is not None:
+            outliers, first_atom, second_atom, third_atom, angle, sigma = worst_angle
+            self.angle_outliers.append(outliers)
+            self.angle_atoms.append((first_atom, second_atom, third_atom))
+            self.angle_value.append(angle)
+            self.angle_sigma.append(sigma)
+        else:
+            self.angle_outliers.append(-1)
+            self.angle_atoms.append(None)
+            self.angle_value.append(0.0)
+            self.angle_sigma.append(0.0)
+
+        if omega is not None:
+            self.omega_range.append(omega[0])
+            self.omega_angle.append(omega[1])
+        else:
+            self.omega_range.append(None)
+            self.omega_angle.append(0.0)
+
+        self.rama_range.append(rama)
+
+        if sidechain is not None:
+            self.sidechain_range.append(sidechain[0])
+            self.rotamer.append(sidechain[1])
+        else:
+            self.sidechain_range.append(None)
+            self.rotamer.append(None)
+
+    @staticmethod
+    def _residue_id_json(
+        number: int, chain: str, residue_type: str, alt_code: str | None
+    ) -> str:
+        return (
+            f'{{"number":{number},"chain":{_str(chain)},'
+            f'"residue_type":{_str(residue_type)}'
+            f'{_optional_str("alt_code", alt_code)}'
+        )
+
+    def _row_json(self, i: int) -> str:
+        parts = [
+            self._residue_id_json(
+                self.number[i], self.chain[i], self.residue_type[i], self.alt_code[i]
+            )
+        ]
+
+        if (atom := self.clash_atom[i]) is not None:
+            other_residue = self.clash_other_residue[i]
+            assert other_residue is not None
+            parts.append(
+                f',"worst_clash":{{"magnitude":{_float(self.clash_magnitude[i])},'
+                f'"atom":{_str(atom)},"other_atom":{_str(self.clash_other_atom[i])},'
+                f'"other_residue":{self._residue_id_json(*other_residue)}}}}}'
+            )
+
+        if (length_atoms := self.length_atoms[i]) is not None:
+            parts.append(
+                f',"bond_length_outlier_count":{self.length_outliers[i]},'
+                f'"worst_bond_length":{{"first_atom":{_str(length_atoms[0])},'
+                f'"second_atom":{_str(length_atoms[1])},'
+                f'"length":{_float(self.length_value[i])},'
+                f'"sigma":{_float(self.length_sigma[i])}}}'
+            )
+
+        if (angle_atoms := self.angle_atoms[i]) is not None:
+            parts.append(
+                f',"bond_angle_outlier_count":{self.angle_outliers[i]},'
+                f'"worst_bond_angle":{{"first_atom":{_str(angle_atoms[0])},'
+                f'"second_atom":{_str(angle_atoms[1])},'
+                f'"third_atom":{_str(angle_atoms[2])},'
+                f'"angle":{_float(self.angle_value[i])},'
+                f'"sigma":{_float(self.angle_sigma[i])}}}'
+            )
+
+        if (omega_range := self.omega_range[i]) is not None:
+            parts.append(
+                f',"omega_torsion":{{"angle_range":{_str(omega_range)},'
+                f'"angle":{_float(self.omega_angle[i])}}}'
+            )
+
+        if (rama_range := self.rama_range[i]) is not None:
+            parts.append(f',"rama_torsion":{{"angle_combo_range":{_str(rama_range)}}}')
+
+        if (sidechain_range := self.sidechain_range[i]) is not None:
+            parts.append(
+                f',"sidechain_torsion":{{"angle_range":{_str(sidechain_range)},'
+                f'"rotamer":{_str(self.rotamer[i])}}}'
+            )
+
+        parts.append("}")
+        return "".join(parts)
+
+    def iter_json(self) -> Iterator[str]:
+        return _iter_rows_json(self._row_json, len(self))
+
+    def to_json(self) -> str:
+        return "".join(self.iter_json())
+
+
+_FILENAME_KEY = ',"filename":'
+
+
+def replace_filename(result_json: str, filename: str) -> str:
+    """
+    Replaces the filename of a serialized `Result` without parsing the rest
+    of it. The filename precedes the models, and a quote inside a JSON string
+    is escaped, so the first match of the key is the filename itself.
+    """
+    start = result_json.index(_FILENAME_KEY) + len(_FILENAME_KEY)
+    _, end = json.JSONDecoder().raw_decode(result_json, start)
+
+    return f"{result_json[:start]}{_str(filename)}{result_json[end:]}"
+
+
+class ClashColumns:
+    """Results of clashscore, one row per clash, and the overall clashscore"""
+
+    def __init__(self) -> None:
+        self.first_residue_number = array("q")
+        self.first_chain: list[str] = []
+        self.first_atom: list[str] = []
+        self.first_insertion_code: list[str | None] = []
+        self.second_residue_number = array("q")
+        self.second_chain: list[str] = []
+        self.second_atom: list[str] = []
+        self.second_insertion_code: list[str | None] = []
+        self.magnitude = array("d")
+        self.clashscore: float | None = None
+
+    def __len__(self) -> int:
+        return len(self.magnitude)
+
+    def append(self, first: ClashAtom, second: ClashAtom, magnitude: float) -> None:
+        self.first_residue_number.append(first.residue_number)
+        self.first_chain.append(first.chain)
+        self.first_atom.append(first.atom)
+        self.first_insertion_code.append(first.insertion_code)
+        self.second_residue_number.append(second.residue_number)
+        self.second_chain.append(second.chain)
+        self.second_atom.append(second.atom)
+        self.second_insertion_code.append(second.insertion_code)
+        self.magnitude.append(magnitude)
+
+    def _row_json(self, i: int) -> str:
+        first_icode = _optional_str("insertion_code", self.first_insertion_code[i])
+        second_icode = _optional_str("insertion_code", self.second_insertion_code[i])
+        return (
+            f'{{"first_atom":{{"residue_number":{self.first_residue_number[i]},'
+            f'"chain":{_str(self.first_chain[i])},"atom":{_str(self.first_atom[i])}'
+            f"{first_icode}}},"
+            f'"second_atom":{{"residue_number":{self.second_residue_number[i]},'
+            f'"chain":{_str(self.second_chain[i])},"atom":{_str(self.second_atom[i])}'
+            f"{second_icode}}},"
+            f'"magnitude":{_float(self.magnitude[i])}}}'
+        )
+
+    def iter_json(self) -> Iterator[str]:
+        return _iter_rows_json(self._row_json, len(self))
+
+    def to_json(self) -> str:
+        return "".join(self.iter_json())
+
+
+@dataclass
+class ColumnarModel:
+    number: int
+    residues: ResidueColumns | None = None
+    clashes: ClashColumns | None = None
+
+    def iter_json(self) -> Iterator[str]:
+        yield f'{{"number":{self.number}'
+        if self.residues is not None:
+            yield ',"residues":'
+            yield from self.residues.iter_json()
+        if self.clashes is not None:
+            yield ',"clashes":'
+            yield from self.clashes.iter_json()
+            if self.clashes.clashscore is not None:
+                yield f',"clashscore":{_float(self.clashes.clashscore)}'
+        yield "}"
+
+
+@dataclass
+class ColumnarResult:
+    """Validation result that serializes to the `Result` JSON schema"""
+
+    status: Status
+    pdb_id: str
+    filename: str
+    models: list[ColumnarModel]
+    # longest timeout of the tool runs, reported with the response but not
+    # part of the result, it depends on the number of jobs
+    applied_timeout: float | None = None
+
+    def iter_json(self) -> Iterator[str]:
+        """Serializes the result in chunks, see CHUNK_ROWS"""
+        yield (
+            f'{{"status":{self.status.model_dump_json(exclude_none=True)},'
+            f'"pdb_id":{_str(self.pdb_id)},"filename":{_str(self.filename)},'
+            f'"models":['
+        )
+        for i, model in enumerate(self.models):
+            if i > 0:
+                yield ","
+            yield from model.iter_json()
+        yield "]}"
+
+    def to_json(self) -> str:
+        return "".join(self.iter_json())
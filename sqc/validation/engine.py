@@ -0,0 +1,92 @@
+import io
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+from typing import Iterator, Protocol
+
+
+class ToolError(Exception):
+    def __init__(self, returncode: int, stderr: bytes) -> None:
+        super().__init__(f"Tool exited with code {returncode}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Engine(Protocol):
+    def stream(self, args: list[str], timeout: float) -> Iterator[str]:
+        """
+        Runs a MolProbity tool and yields the lines of its output as they are
+        produced. Raises subprocess.TimeoutExpired on timeout and ToolError
+        once the output is consumed if the tool failed.
+        """
+        ...
+
+
+class SubprocessEngine:
+    """Runs every MolProbity tool invocation in a fresh subprocess"""
+
+    def stream(self, args: list[str], timeout: float) -> Iterator[str]:
+        # stderr is only read on failure, a file keeps the tool from blocking
+        # on a full pipe meanwhile
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                # children of the tool hold the pipe open, they are killed too
+                start_new_session=True,
+            )
+            assert proc.stdout is not None
+
+            expired = threading.Event()
+
+            def kill() -> None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            def expire() -> None:
+                expired.set()
+                kill()
+
+            timer = threading.Timer(timeout, expire)
+            timer.start()
+
+            try:
+                yield from io.TextIOWrapper(proc.stdout, encoding="utf-8")
+                returncode = proc.wait()
+            finally:
+                # also reached when the consumer stops reading early
+                timer.cancel()
+                if proc.poll() is None:
+                    kill()
+                proc.wait()
+                proc.stdout.close()
+
+            if expired.is_set():
+                raise subprocess.TimeoutExpired(args, timeout)
+
+            if returncode != 0:
+                stderr.seek(0)
+                raise ToolError(returncode, stderr.read())
+
+
+_engine: Engine = SubprocessEngine()
+_engine_lock = threading.Lock()
+
+
+def default_engine() -> Engine:
+    """Returns the process-wide engine"""
+    with _engine_lock:
+        return _engine
+
+
+def set_default_engine(engine: Engine) -> None:
+    """Replaces the process-wide engine, e.g. with a stand-in in benchmarks"""
+    global _engine
+
+    with _engine_lock:
+        _engine = engine
@@ -1,10 +1,22 @@
+from array import array
+from dataclasses import dataclass, field
+import functools
+import hashlib
+from io import StringIO
+import os
+from typing import NamedTuple
+
+from Bio.Data.IUPACData import atom_weights
+from Bio.PDB.Atom import Atom
 from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.parse_pdb_header import parse_pdb_header
-from Bio.PDB.PDBIO import PDBIO, Select
+from Bio.PDB.PDBIO import PDBIO, Select, _ATOM_FORMAT_STRING, _TER_FORMAT_STRING
 from Bio.PDB.Model import Model
 
 from structlog import get_logger
 
+from sqc.metrics import timed
+
 logger = get_logger()
 
 
@@ -17,32 +29,353 @@ class ModelSelector(Select):
         return 1 if model.serial_num == self.serial_num else 0
 
 
-def get_pdb_id(path: str) -> str | None:
-    with open(path, "r") as pdb_file:
-        header = parse_pdb_header(pdb_file)
-        return header.get("idcode", "unknown")
+@dataclass
+class LoadedStructure:
+    pdb_id: str
+    models: list[tuple[int, str]]
+    # atoms of all models
+    atoms: int = 0
+
 
+@timed("split_models")
+def load_structure(path: str) -> LoadedStructure:
+    """
+    Derives the PDB id and per-model files (for multimodel files) of the PDB
+    file. The MODEL_SPLITTER environment variable selects the streaming
+    splitter ("stream", default) or Biopython's structure tree ("biopython").
+    """
+    if os.environ.get("MODEL_SPLITTER", "stream") == "stream":
+        try:
+            return _load_structure_stream(path)
+        except _UnsupportedRecords as err:
+            logger.debug("Falling back to Biopython model splitter", reason=str(err))
 
-def split_models(path: str) -> list[tuple[int, str]]:
-    """Splits multimodel PDB files into multiple files (one per model)"""
-    parser = PDBParser()
-    pdb_id = get_pdb_id(path) or "unknown_pdb_id"
-    structure = parser.get_structure(pdb_id, path)
+    return _load_structure_tree(path)
+
+
+def _load_structure_tree(path: str) -> LoadedStructure:
+    """
+    Parses the PDB file once and derives its PDB id and per-model files
+    (for multimodel files) from the parsed structure
+    """
+    structure = PDBParser().get_structure("structure", path)
+    pdb_id = structure.header.get("idcode") or "unknown_pdb_id"
+    models = list(structure.get_models())
+    atoms = sum(1 for _ in structure.get_atoms())
 
     # use original file if it contains only one model
-    if len(list(structure.get_models())) == 1:
-        return [(1, path)]
+    if len(models) == 1:
+        return LoadedStructure(pdb_id, [(1, path)], atoms)
 
+    # the selector rejects other models as a whole, so every atom is only
+    # visited when its own model is written
     io = PDBIO()
     io.set_structure(structure)
-    models = []
+    model_paths = []
 
-    for model in structure.get_models():
+    for model in models:
         selector = ModelSelector(model.serial_num)
         new_path = f"{path}-model-{model.serial_num}.pdb"
         io.save(new_path, select=selector)
-        models.append((model.serial_num, new_path))
+        model_paths.append((model.serial_num, new_path))
+
+    logger.debug("Split models into new PDB files", paths=model_paths)
+
+    return LoadedStructure(pdb_id, model_paths, atoms)
+
+
+class _UnsupportedRecords(Exception):
+    """
+    Raised by the streaming splitter for records it cannot reproduce exactly
+    as Biopython would (alternate locations, redefined residues, ...)
+    """
+
+
+@functools.lru_cache(maxsize=4096)
+def _atom_name_and_element(fullname: str, name: str, element: str) -> tuple[str, str]:
+    """Formats the atom name and element columns like PDBIO does"""
+    # the element is guessed from the atom name if the column is invalid
+    element = Atom(name, None, 0.0, None, " ", fullname, 0, element).element
+    element = element.strip().upper() if element else ""
+    if element and element.capitalize() not in atom_weights and element != "X":
+        raise _UnsupportedRecords(f"Unrecognised element {element}")
+
+    name = fullname.strip()
+    if len(name) < 4 and name[:1].isalpha() and len(element) < 2:
+        name = " " + name
+
+    return name, element.rjust(2)
+
+
+class _AtomRecord(NamedTuple):
+    record_type: str
+    fullname: str
+    name: str
+    altloc: str
+    resname: str
+    chain_id: str
+    resseq: int
+    icode: str
+    coords: tuple[float, float, float]
+
+
+def _parse_atom_record(line: str) -> _AtomRecord:
+    """Parses the fields of an ATOM/HETATM record that PDBParser requires"""
+    try:
+        fullname = line[12:16]
+        split_name = fullname.split()
+        name = split_name[0] if len(split_name) == 1 else fullname
+        return _AtomRecord(
+            line[0:6],
+            fullname,
+            name,
+            line[16],
+            line[17:20].strip(),
+            line[21],
+            int(line[22:26].split()[0]),
+            line[26],
+            (float(line[30:38]), float(line[38:46]), float(line[46:54])),
+        )
+    except (ValueError, IndexError) as err:
+        raise _UnsupportedRecords("Malformed atom record") from err
+
+
+@dataclass
+class _Residue:
+    record_type: str
+    resname: str
+    resseq: int
+    icode: str
+    segid: str
+    # (atom name, element, occupancy, B-factor, offset of the coordinates)
+    atoms: list[tuple[str, str, str, float, int]] = field(default_factory=list)
+    atom_names: set[str] = field(default_factory=set)
+
+
+class _ModelRecords:
+    """
+    Atom records of a single model, grouped into chains and residues the
+    same way Biopython's PDBParser builds its structure
+    """
+
+    def __init__(self, serial_num: int) -> None:
+        self.serial_num = serial_num
+        self.chains: dict[str, list[_Residue]] = {}
+        self.coords = array("d")
+        self._chain_id: str | None = None
+        self._residue_id: tuple[str, int, str] | None = None
+        self._residue_ids: dict[str, set[tuple[str, int, str]]] = {}
+
+    def add(self, line: str) -> None:
+        atom = _parse_atom_record(line)
+
+        try:
+            occupancy = f"{float(line[54:60]):6.2f}"
+        except ValueError:
+            occupancy = " " * 6
+        try:
+            bfactor = float(line[60:66])
+        except ValueError:
+            bfactor = 0.0
+
+        if atom.altloc != " ":
+            raise _UnsupportedRecords("Alternate locations")
+
+        resname = atom.resname
+        if atom.record_type == "HETATM":
+            hetfield = "W" if resname in ("HOH", "WAT") else "H_" + resname
+        else:
+            hetfield = " "
+        residue_id = (hetfield, atom.resseq, atom.icode)
+        chain_id = atom.chain_id
+
+        if chain_id != self._chain_id:
+            # residues of discontinuous chains are appended to the chain
+            self._chain_id = chain_id
+            self._residue_id = None
+            self.chains.setdefault(chain_id, [])
+            self._residue_ids.setdefault(chain_id, set())
+
+        residues = self.chains[chain_id]
+        if residue_id != self._residue_id or resname != residues[-1].resname:
+            if residue_id in self._residue_ids[chain_id]:
+                raise _UnsupportedRecords("Redefined residue")
+            self._residue_id = residue_id
+            self._residue_ids[chain_id].add(residue_id)
+            residues.append(
+                _Residue(
+                    atom.record_type, resname, atom.resseq, atom.icode, line[72:76]
+                )
+            )
+
+        residue = residues[-1]
+        if atom.name in residue.atom_names:
+            raise _UnsupportedRecords("Duplicate atom")
+        residue.atom_names.add(atom.name)
+
+        name, element = _atom_name_and_element(
+            atom.fullname, atom.name, line[76:78].strip().upper()
+        )
+        residue.atoms.append((name, element, occupancy, bfactor, len(self.coords)))
+        self.coords.extend(atom.coords)
+
+    def write(self, path: str) -> None:
+        """Writes the model the way PDBIO saves it from a multimodel structure"""
+        # Biopython keeps coordinates in single precision
+        coords = array("f", self.coords).tolist()
+        atom_number = 1
+
+        with open(path, "w") as pdb_file:
+            pdb_file.write(f"MODEL      {self.serial_num}\n")
+
+            for chain_id, residues in self.chains.items():
+                for residue in residues:
+                    for name, element, occupancy, bfactor, i in residue.atoms:
+                        if atom_number > 99999:
+                            raise _UnsupportedRecords("Too many atoms")
+
+                        pdb_file.write(
+                            _ATOM_FORMAT_STRING
+                            % (
+                                residue.record_type,
+                                atom_number,
+                                name,
+                                " ",
+                                residue.resname,
+                                chain_id,
+                                residue.resseq,
+                                residue.icode,
+                                coords[i],
+                                coords[i + 1],
+                                coords[i + 2],
+                                occupancy,
+                                bfactor,
+                                residue.segid,
+                                element,
+                                "  ",
+                            )
+                        )
+                        atom_number += 1
+
+                pdb_file.write(
+                    _TER_FORMAT_STRING
+                    % (
+                        atom_number,
+                        residue.resname,
+                        chain_id,
+                        residue.resseq,
+                        residue.icode,
+                    )
+                )
+
+            if self.chains:
+                pdb_file.write("ENDMDL\n")
+            pdb_file.write("END   \n")
+
+
+def _load_structure_stream(path: str) -> LoadedStructure:
+    """
+    Splits the PDB file into per-model files in a single pass over its
+    records, holding at most two models in memory. The output matches the
+    Biopython splitter byte for byte, records it cannot reproduce raise
+    _UnsupportedRecords.
+    """
+    header: list[str] = []
+    model_paths: list[tuple[int, str]] = []
+    serial_nums: set[int] = set()
+    implicit_model = False
+    atoms = 0
+    model: _ModelRecords | None = None
+    # the first model is only written once a second one is found, files with
+    # a single model are validated as they are
+    first_model: _ModelRecords | None = None
+
+    def close_model() -> None:
+        nonlocal model, first_model
+        assert model is not None
+
+        if not serial_nums - {model.serial_num} and first_model is None:
+            first_model = model
+        else:
+            for records in (first_model, model):
+                if records is not None:
+                    new_path = f"{path}-model-{records.serial_num}.pdb"
+                    records.write(new_path)
+                    model_paths.append((records.serial_num, new_path))
+            first_model = None
+
+        model = None
+
+    with open(path, "r") as pdb_file:
+        in_header = True
+        for line in pdb_file:
+            if in_header:
+                if line[0:6] not in ("ATOM  ", "HETATM", "MODEL "):
+                    header.append(line)
+                    continue
+                in_header = False
+
+            line = line.rstrip("\n")
+            record_type = line[0:6]
+            if not line.strip():
+                continue
+            elif record_type == "ATOM  " or record_type == "HETATM":
+                atoms += 1
+                if model is None:
+                    if serial_nums:
+                        raise _UnsupportedRecords("Atoms outside of MODEL records")
+                    # the records are only checked, the original file is used
+                    implicit_model = True
+                    _parse_atom_record(line)
+                else:
+                    model.add(line)
+            elif record_type == "MODEL ":
+                if implicit_model:
+                    raise _UnsupportedRecords("Atoms outside of MODEL records")
+                if model is not None:
+                    close_model()
+
+                try:
+                    serial_num = int(line[10:14])
+                except ValueError:
+                    serial_num = 0
+                if serial_num in serial_nums:
+                    raise _UnsupportedRecords("Duplicate model serial number")
+
+                serial_nums.add(serial_num)
+                model = _ModelRecords(serial_num)
+            elif record_type == "ENDMDL":
+                if model is not None:
+                    close_model()
+            elif record_type == "END   " or record_type == "CONECT":
+                break
+
+        if model is not None:
+            close_model()
+
+    pdb_id = parse_pdb_header(StringIO("".join(header))).get("idcode")
+    pdb_id = pdb_id or "unknown_pdb_id"
+
+    # use original file if it contains only one model
+    if len(serial_nums) + implicit_model == 1:
+        return LoadedStructure(pdb_id, [(1, path)], atoms)
+
+    logger.debug("Split models into new PDB files", paths=model_paths)
+
+    return LoadedStructure(pdb_id, model_paths, atoms)
+
+
+def fingerprint_model(path: str) -> str:
+    """
+    Hashes the records of a model file, ignoring the MODEL/ENDMDL records,
+    so that models differing only in their serial number share a fingerprint
+    """
+    digest = hashlib.sha256()
 
-    logger.debug("Split models into new PDB files", paths=models)
+    with open(path, "rb") as pdb_file:
+        for line in pdb_file:
+            if line.startswith((b"MODEL", b"ENDMDL")):
+                continue
+            digest.update(line)
 
-    return models
+    return digest.hexdigest()
@@ -58,6 +58,7 @@ class Atom(BaseModel):
     residue_number: int
     chain: str
     atom: str
+    insertion_code: str | None = None
 
 
 class Clash(BaseModel):
@@ -70,6 +71,7 @@ class Model(BaseModel):
     number: int
     residues: list[Residue] | None = None
     clashes: list[Clash] | None = None
+    clashscore: float | None = None
 
 
 class DataVersion(BaseModel):
@@ -85,10 +87,28 @@ class MolProbityVersions(BaseModel):
     rama_z_version: DataVersion
 
 
+class Progress(BaseModel):
+    """
+    Progress of a validation that is still running. Models are listed as soon
+    as one of their tools finished, the results of the other one follow.
+    """
+
+    models: int
+    completed_models: int
+    completed_runs: int
+    total_runs: int
+
+
 class Status(BaseModel):
     residue_analysis: bool = True
     clashscore: bool = True
     molprobity_versions: MolProbityVersions
+    # only set in partial results
+    progress: Progress | None = None
+
+
+# part of the result cache keys, bump it whenever the result JSON changes
+RESULT_SCHEMA_VERSION = 3
 
 
 class Result(BaseModel):
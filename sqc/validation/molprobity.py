@@ -1,24 +1,18 @@
-from typing import Any
+from typing import Iterator
+import re
 import subprocess
 import csv
+import sys
+import threading
+from time import perf_counter
 
 from structlog import get_logger
-import git
 
+from sqc.metrics import TOOL_TIMEOUT_SECONDS, TOOL_TIMEOUTS, timed
 from sqc.repository import InternalError
-from sqc.validation.model import (
-    Atom,
-    Clash,
-    DataVersion,
-    MolProbityVersions,
-    OmegaTorsion,
-    RamaTorsion,
-    Residue,
-    SidechainTorsion,
-    WorstBondAngle,
-    WorstBondLength,
-    WorstClash,
-)
+from sqc.validation.engine import Engine, ToolError, default_engine
+from sqc.validation.columns import ClashAtom, ClashColumns, ResidueColumns, ResidueId
+from sqc.validation.timeouts import TimeoutPolicy
 
 logger = get_logger()
 
@@ -28,82 +22,88 @@ class MolProbityError(Exception):
         super().__init__(*args)
 
 
-class MolProbity:
-    GEOSTD_REPO_PATH = "/molprobity/modules/chem_data/geostd"
-    MON_LIB_REPO_PATH = "/molprobity/modules/chem_data/mon_lib"
-    ROTARAMA_DATA_REPO_PATH = "/molprobity/modules/chem_data/rotarama_data"
-    CABLAM_DATA_REPO_PATH = "/molprobity/modules/chem_data/cablam_data"
-    RAMA_Z_REPO_PATH = "/molprobity/modules/chem_data/rama_z"
+def _clash_atom_pattern(prefix: str) -> str:
+    # the residue number is at most 4 digits wide and gets joined with the
+    # chain ID when the columns overflow, e.g. "X1194 TYR  OH"
+    return (
+        rf"(?P<{prefix}chain>\S*?)\s*(?P<{prefix}number>-?\d{{1,4}})"
+        rf"(?P<{prefix}icode>[A-Za-z]?)\s+\S+\s+(?P<{prefix}atom>\S+)"
+    )
 
-    CLASHSCORE_LINE_ATOMS_LEN = 34
 
-    def __init__(self, timeout=600) -> None:
+class MolProbity:
+    # e.g. " A  72  ARG  HG2  B1034  ASP  C   :0.816"
+    CLASH_LINE = re.compile(
+        rf"^\s*{_clash_atom_pattern('first_')}(?:\s*:\s*|\s+)"
+        rf"{_clash_atom_pattern('second_')}\s*:\s*(?P<magnitude>-?\d*\.?\d+)\s*$"
+    )
+    CLASHSCORE_LINE = re.compile(r"^\s*clashscore\s*=\s*(?P<clashscore>-?\d*\.?\d+)")
+
+    def __init__(
+        self,
+        timeout=600,
+        engine: Engine | None = None,
+        policy: TimeoutPolicy | None = None,
+        concurrent_runs: int = 1,
+    ) -> None:
+        """
+        Runs are limited to `timeout` seconds, unless a `policy` is given and
+        the atoms of the model are known. `concurrent_runs` is the number of
+        tool runs of the request that share the CPUs.
+        """
         self.timeout = timeout
-        self.geostd_repo = git.Repo(self.GEOSTD_REPO_PATH)
-        self.mon_lib_repo = git.Repo(self.MON_LIB_REPO_PATH)
-        self.rotarama_data_repo = git.Repo(self.ROTARAMA_DATA_REPO_PATH)
-        self.cablam_data_repo = git.Repo(self.CABLAM_DATA_REPO_PATH)
-        self.rama_z_repo = git.Repo(self.RAMA_Z_REPO_PATH)
-
-    def _residue_analysis_output(self, path: str) -> str:
-        try:
-            proc = subprocess.run(
-                ["residue-analysis", path], capture_output=True, timeout=self.timeout
-            )
-        except subprocess.TimeoutExpired:
-            logger.warning(
-                "Failed to run molprobity residue-analysis in time",
-                timeout=self.timeout,
-            )
-            raise MolProbityError("Failed to run residue analysis in time")
+        self.engine = engine if engine is not None else default_engine()
+        self.policy = policy
+        self.concurrent_runs = concurrent_runs
+        # the longest timeout applied to a run so far
+        self.applied_timeout: float | None = None
+        self._lock = threading.Lock()
+
+    def _timeout(self, tool: str, atoms: int | None) -> float:
+        if self.policy is None or atoms is None:
+            timeout = self.timeout
+        else:
+            timeout = self.policy.timeout(tool, atoms, self.concurrent_runs)
+        TOOL_TIMEOUT_SECONDS.labels(tool).observe(timeout)
 
-        if proc.returncode != 0:
-            logger.error(
-                "residue-analysis exited with non-zero code", stderr=proc.stderr
-            )
-            raise InternalError()
+        with self._lock:
+            if self.applied_timeout is None or timeout > self.applied_timeout:
+                self.applied_timeout = timeout
 
-        return proc.stdout.decode(encoding="utf-8")
+        return timeout
 
-    def _clashscore_output(self, path: str) -> str:
+    def _tool_lines(
+        self, tool: str, path: str, atoms: int | None = None
+    ) -> Iterator[str]:
+        timeout = self._timeout(tool, atoms)
+        start = perf_counter()
         try:
-            proc = subprocess.run(
-                ["clashscore", path], capture_output=True, timeout=self.timeout
-            )
+            yield from self.engine.stream([tool, path], timeout)
         except subprocess.TimeoutExpired:
+            TOOL_TIMEOUTS.labels(tool).inc()
             logger.warning(
-                "Failed to run molprobity clashscore in time",
-                timeout=self.timeout,
+                f"Failed to run molprobity {tool} in time",
+                timeout=timeout,
+                atoms=atoms,
             )
-            raise MolProbityError("Failed to run residue analysis in time")
-
-        if proc.returncode != 0:
-            logger.error("clashscore exited with non-zero code", stderr=proc.stderr)
+            raise MolProbityError(f"Failed to run {tool} in time")
+        except ToolError as err:
+            logger.error(f"{tool} exited with non-zero code", stderr=err.stderr)
             raise InternalError()
 
-        return proc.stdout.decode(encoding="utf-8")
+        if self.policy is not None and atoms is not None:
+            self.policy.observe(tool, atoms, perf_counter() - start)
 
-    @staticmethod
-    def _nullify_row(row: dict[str, Any]) -> None:
-        """Changes dict values from empty strings to None"""
-        for key, val in row.items():
-            if val == "":
-                row[key] = None
-
-    def _get_analysis_dict(self, path: str) -> dict[str, Any]:
-        output = self._residue_analysis_output(path).splitlines()
-        reader = csv.DictReader(output, dialect="unix")
-
-        per_residue_analysis: dict[str, Any] = {}
-        for residue_row in reader:
-            residue = residue_row.pop("residue")
-            self._nullify_row(residue_row)
-            per_residue_analysis[residue] = residue_row
+    def _residue_analysis_lines(
+        self, path: str, atoms: int | None = None
+    ) -> Iterator[str]:
+        return self._tool_lines("residue-analysis", path, atoms)
 
-        return per_residue_analysis
+    def _clashscore_lines(self, path: str, atoms: int | None = None) -> Iterator[str]:
+        return self._tool_lines("clashscore", path, atoms)
 
     @staticmethod
-    def _parse_residue(residue: str) -> Residue:
+    def _parse_residue(residue: str) -> ResidueId:
         split = residue.split()
 
         # When the residue number is 4 digits long, it gets joined with the
@@ -133,166 +133,169 @@ class MolProbity:
             alt_code = remaining_part[0]
             type = remaining_part[1]
 
-        return Residue(number=number, chain=chain, residue_type=type, alt_code=alt_code)
+        # the same chains and residue types repeat on every row
+        return ResidueId(number, sys.intern(chain), sys.intern(type), alt_code)
 
     @staticmethod
-    def _get_data_version(repo: git.Repo) -> DataVersion:
-        url = repo.remote().url
-        sha = repo.commit().hexsha
-        return DataVersion(url=url, commit_sha=sha)
-
-    def get_data_versions(self) -> MolProbityVersions:
-        return MolProbityVersions(
-            geostd_version=self._get_data_version(self.geostd_repo),
-            mon_lib_version=self._get_data_version(self.mon_lib_repo),
-            rotarama_version=self._get_data_version(self.rotarama_data_repo),
-            cablam_version=self._get_data_version(self.cablam_data_repo),
-            rama_z_version=self._get_data_version(self.rama_z_repo),
+    def _parse_worst_length(
+        outliers: str, atoms: str, length: str, sigma: str
+    ) -> tuple[int, str, str, float, float]:
+        first_atom, second_atom = atoms.split("--")
+
+        return (
+            int(outliers),
+            sys.intern(first_atom),
+            sys.intern(second_atom),
+            float(length),
+            float(sigma),
         )
 
-    def _parse_worst_length(self, analysis: dict[str, Any]) -> WorstBondLength:
-        first_atom, second_atom = analysis["worst_length"].split("--")
-        length = analysis["worst_length_value"]
-        sigma = analysis["worst_length_sigma"]
-
-        return WorstBondLength(
-            first_atom=first_atom, second_atom=second_atom, length=length, sigma=sigma
-        )
-
-    def _parse_worst_angle(self, analysis: dict[str, Any]) -> WorstBondAngle:
-        first_atom, second_atom, third_atom = analysis["worst_angle"].split("-")
-        angle = analysis["worst_angle_value"]
-        sigma = analysis["worst_angle_sigma"]
-
-        return WorstBondAngle(
-            first_atom=first_atom,
-            second_atom=second_atom,
-            third_atom=third_atom,
-            angle=angle,
-            sigma=sigma,
+    @staticmethod
+    def _parse_worst_angle(
+        outliers: str, atoms: str, angle: str, sigma: str
+    ) -> tuple[int, str, str, str, float, float]:
+        first_atom, second_atom, third_atom = atoms.split("-")
+
+        return (
+            int(outliers),
+            sys.intern(first_atom),
+            sys.intern(second_atom),
+            sys.intern(third_atom),
+            float(angle),
+            float(sigma),
         )
 
     @staticmethod
-    def _parse_clash_atom(raw: str) -> Atom:
+    def _parse_clash_atom(clash: re.Match, prefix: str) -> ClashAtom:
         """
-        Parse a clash atom from molprobity clashscore output
-
-        When the residue number is 4 digits long, it gets joined with the
-        chain ID in the output. "X1194 TYR G2" instead of
-        "X 1194 TYR G2"
+        Builds a clash atom from the groups of a CLASH_LINE match
 
         Input examples:
             - "A   9  LYS  CA"
             - "X1034  ASP  C"
+            - "AB  12A GLU  O"
 
         Outputs:
-            - Atom(chain="A", residue_number=9, atom="CA")
-            - Atom(chain="X", residue_number=1034, atom="C")
+            - ClashAtom(residue_number=9, chain="A", atom="CA")
+            - ClashAtom(residue_number=1034, chain="X", atom="C")
+            - ClashAtom(residue_number=12, chain="AB", atom="O", insertion_code="A")
         """
-        chain = raw[0]
-        split = raw.split()
-
-        # chain is 5 characters long only when the residue
-        # number invades its space
-        if len(raw.split()[0]) == 5:
-            chain = chain[0]
-            residue_number = int(split[0][1:])
-            atom = split[2]
-        else:
-            residue_number = int(split[1])
-            atom = split[3]
-
-        return Atom(chain=chain, residue_number=residue_number, atom=atom)
+        return ClashAtom(
+            int(clash[f"{prefix}number"]),
+            sys.intern(clash[f"{prefix}chain"]),
+            sys.intern(clash[f"{prefix}atom"]),
+            clash[f"{prefix}icode"] or None,
+        )
 
-    def clashscore(self, path: str) -> list[Clash]:
+    @timed("clashscore")
+    def clashscore(self, path: str, atoms: int | None = None) -> ClashColumns:
         logger.debug("Running clashscore", path=path)
-        output = self._clashscore_output(path)
-        clashes = []
-
-        # since the clashscore program has no specified output format,
-        # we need to do ugly magic to the output to remove garbage
-        # TODO: refactor this to make it more apparent
-        output_lines = output.splitlines()[:-2]
-        if "hydrogen addition" in output_lines[2]:
-            garbage_lines = 5
-        else:
-            garbage_lines = 4
-
-        for clash_line in output_lines[garbage_lines:]:
-            first_atom_part = clash_line[: self.CLASHSCORE_LINE_ATOMS_LEN // 2].strip()
-
-            second_atom_part = clash_line[
-                (self.CLASHSCORE_LINE_ATOMS_LEN // 2) + 1 :
-            ].strip()
-
-            first_atom = self._parse_clash_atom(first_atom_part)
-            second_atom = self._parse_clash_atom(second_atom_part)
-
-            # remove colon from magnitude field
-            magnitude = float(clash_line[self.CLASHSCORE_LINE_ATOMS_LEN + 1 :])
-
-            clashes.append(
-                Clash(
-                    first_atom=first_atom, second_atom=second_atom, magnitude=magnitude
+        clashes = ClashColumns()
+
+        # the output has no specified format, clash lines and the summary are
+        # recognised by their pattern and everything else is skipped
+        for line in self._clashscore_lines(path, atoms):
+            if clash := self.CLASH_LINE.match(line):
+                clashes.append(
+                    self._parse_clash_atom(clash, "first_"),
+                    self._parse_clash_atom(clash, "second_"),
+                    float(clash["magnitude"]),
                 )
-            )
+            elif summary := self.CLASHSCORE_LINE.match(line):
+                clashes.clashscore = float(summary["clashscore"])
 
         return clashes
 
-    def residue_analysis(self, path: str) -> list[Residue]:
+    @timed("residue_analysis")
+    def residue_analysis(self, path: str, atoms: int | None = None) -> ResidueColumns:
         logger.debug("Running residue-analysis", path=path)
-        all_analysis = self._get_analysis_dict(path)
-        residues = []
-
-        for residue_id, analysis in all_analysis.items():
-            residue = self._parse_residue(residue_id)
-
-            if analysis["worst_clash"] is not None:
-                magnitude = float(analysis["worst_clash"])
-                atom = analysis["src_atom"].strip()
-                other_atom = analysis["dst_atom"].strip()
-                dst_residue = self._parse_residue(analysis["dst_residue"])
-
-                residue.worst_clash = WorstClash(
-                    magnitude=magnitude,
-                    atom=atom,
-                    other_atom=other_atom,
-                    other_residue=dst_residue,
-                )
-
-            if analysis["num_length_out"] is not None:
-                residue.bond_length_outlier_count = int(analysis["num_length_out"])
-                residue.worst_bond_length = self._parse_worst_length(analysis)
+        reader = csv.reader(self._residue_analysis_lines(path, atoms), dialect="unix")
+        residues = ResidueColumns()
+
+        header = next(reader, None)
+        if header is None:
+            return residues
+
+        columns = {name: i for i, name in enumerate(header)}
+        n_columns = len(header)
+        residue_col = columns["residue"]
+        clash_col = columns["worst_clash"]
+        src_atom_col = columns["src_atom"]
+        dst_atom_col = columns["dst_atom"]
+        dst_residue_col = columns["dst_residue"]
+        length_out_col = columns["num_length_out"]
+        length_col = columns["worst_length"]
+        length_value_col = columns["worst_length_value"]
+        length_sigma_col = columns["worst_length_sigma"]
+        angle_out_col = columns["num_angle_out"]
+        angle_col = columns["worst_angle"]
+        angle_value_col = columns["worst_angle_value"]
+        angle_sigma_col = columns["worst_angle_sigma"]
+        omega_col = columns["omega"]
+        omega_eval_col = columns["omega_eval"]
+        rama_eval_col = columns["rama_eval"]
+        rotamer_eval_col = columns["rotamer_eval"]
+        rotamer_col = columns["rotamer"]
+
+        # residues are often the clash partner (dst_residue) of other residues
+        parsed_residues: dict[str, ResidueId] = {}
+
+        def parse_residue(raw: str) -> ResidueId:
+            if (residue := parsed_residues.get(raw)) is None:
+                residue = parsed_residues[raw] = self._parse_residue(raw)
+            return residue
+
+        for row in reader:
+            if len(row) < n_columns:
+                if not row:
+                    continue
+                row += [""] * (n_columns - len(row))
+
+            length_out = row[length_out_col]
+            angle_out = row[angle_out_col]
+            omega = row[omega_col]
+            rama_eval = row[rama_eval_col]
+            rotamer_eval = row[rotamer_eval_col]
 
-            if analysis["num_angle_out"] is not None:
-                residue.bond_angle_outlier_count = int(analysis["num_angle_out"])
-                residue.worst_bond_angle = self._parse_worst_angle(analysis)
-
-            if analysis["omega"] is not None:
-                angle = float(analysis["omega"])
-                angle_range = analysis["omega_eval"]
-                residue.omega_torsion = OmegaTorsion(
-                    angle=angle, angle_range=angle_range
+            # skip residue if no outliers found
+            if not (length_out or angle_out or omega or rama_eval or rotamer_eval):
+                continue
+
+            worst_clash = None
+            if clash := row[clash_col]:
+                worst_clash = (
+                    float(clash),
+                    sys.intern(row[src_atom_col].strip()),
+                    sys.intern(row[dst_atom_col].strip()),
+                    parse_residue(row[dst_residue_col]),
                 )
 
-            if analysis["rama_eval"] is not None:
-                residue.rama_torsion = RamaTorsion(
-                    angle_combo_range=analysis["rama_eval"]
+            worst_length = None
+            if length_out:
+                worst_length = self._parse_worst_length(
+                    length_out,
+                    row[length_col],
+                    row[length_value_col],
+                    row[length_sigma_col],
                 )
 
-            if analysis["rotamer_eval"] is not None:
-                residue.sidechain_torsion = SidechainTorsion(
-                    angle_range=analysis["rotamer_eval"], rotamer=analysis["rotamer"]
+            worst_angle = None
+            if angle_out:
+                worst_angle = self._parse_worst_angle(
+                    angle_out,
+                    row[angle_col],
+                    row[angle_value_col],
+                    row[angle_sigma_col],
                 )
 
-            # skip residue if no outliers found
-            if (
-                residue.bond_angle_outlier_count is not None
-                or residue.bond_length_outlier_count is not None
-                or residue.omega_torsion is not None
-                or residue.sidechain_torsion is not None
-                or residue.rama_torsion is not None
-            ):
-                residues.append(residue)
+            residues.append(
+                parse_residue(row[residue_col]),
+                worst_clash=worst_clash,
+                worst_length=worst_length,
+                worst_angle=worst_angle,
+                omega=(row[omega_eval_col], float(omega)) if omega else None,
+                rama=rama_eval or None,
+                sidechain=(rotamer_eval, row[rotamer_col]) if rotamer_eval else None,
+            )
 
         return residues
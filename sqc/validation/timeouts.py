@@ -0,0 +1,97 @@
+from collections import deque
+import math
+import os
+import threading
+
+
+class TimeoutPolicy:
+    """
+    Timeouts of MolProbity tool runs. The "adaptive" policy scales the
+    timeout with the atoms of the model and with the number of tool runs
+    competing for the CPUs. Once a tool has enough successful runs on models
+    of a similar size (a power of two bucket of atoms), the timeout follows
+    `headroom` times their rolling p99 instead. The "fixed" policy applies
+    the same timeout to every run.
+    """
+
+    def __init__(
+        self,
+        adaptive: bool = True,
+        fixed: float = 600,
+        base: float = 60,
+        per_atom: float = 0.005,
+        minimum: float = 30,
+        maximum: float = 3600,
+        headroom: float = 3,
+        window: int = 200,
+        min_samples: int = 20,
+    ) -> None:
+        self.adaptive = adaptive
+        self.fixed = fixed
+        self.base = base
+        self.per_atom = per_atom
+        self.minimum = minimum
+        self.maximum = maximum
+        self.headroom = headroom
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._runtimes: dict[tuple[str, int], deque[float]] = {}
+
+    @staticmethod
+    def from_env() -> "TimeoutPolicy":
+        return TimeoutPolicy(
+            adaptive=os.environ.get("MOLPROBITY_TIMEOUT_POLICY", "adaptive")
+            == "adaptive",
+            fixed=float(os.environ.get("MOLPROBITY_TIMEOUT", 600)),
+            base=float(os.environ.get("MOLPROBITY_TIMEOUT_BASE", 60)),
+            per_atom=float(os.environ.get("MOLPROBITY_TIMEOUT_PER_ATOM", 0.005)),
+            minimum=float(os.environ.get("MOLPROBITY_TIMEOUT_MIN", 30)),
+            maximum=float(os.environ.get("MOLPROBITY_TIMEOUT_MAX", 3600)),
+            headroom=float(os.environ.get("MOLPROBITY_TIMEOUT_HEADROOM", 3)),
+        )
+
+    @staticmethod
+    def _bucket(tool: str, atoms: int) -> tuple[str, int]:
+        return tool, atoms.bit_length()
+
+    def _p99(self, tool: str, atoms: int) -> float | None:
+        with self._lock:
+            runtimes = self._runtimes.get(self._bucket(tool, atoms))
+            if runtimes is None or len(runtimes) < self.min_samples:
+                return None
+            ordered = sorted(runtimes)
+
+        return ordered[math.ceil(0.99 * len(ordered)) - 1]
+
+    def timeout(self, tool: str, atoms: int, concurrent_runs: int = 1) -> float:
+        """Timeout of a run of `tool` on a model with `atoms` atoms"""
+        if not self.adaptive:
+            return self.fixed
+
+        if (p99 := self._p99(tool, atoms)) is not None:
+            timeout = self.headroom * p99
+        else:
+            timeout = self.base + self.per_atom * atoms
+
+        # runs beyond the number of CPUs slow each other down
+        timeout *= max(1.0, concurrent_runs / (os.cpu_count() or 1))
+
+        return min(max(timeout, self.minimum), self.maximum)
+
+    def limit(self, seconds: float) -> None:
+        """Caps the timeouts of both policies at `seconds`"""
+        self.maximum = min(self.maximum, seconds)
+        self.fixed = min(self.fixed, seconds)
+
+    def observe(self, tool: str, atoms: int, seconds: float) -> None:
+        """Records the runtime of a successful run"""
+        with self._lock:
+            bucket = self._bucket(tool, atoms)
+            if (runtimes := self._runtimes.get(bucket)) is None:
+                runtimes = self._runtimes[bucket] = deque(maxlen=self.window)
+            runtimes.append(seconds)
+
+
+# shared by all worker threads, so that every request learns from the others
+timeout_policy = TimeoutPolicy.from_env()
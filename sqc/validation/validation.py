@@ -1,46 +1,265 @@
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import contextvars
+import dataclasses
+from typing import Callable
+
 from structlog import get_logger
 
-from sqc.validation.io import get_pdb_id, split_models
-from sqc.validation.model import (
-    Model,
-    Result,
-    Status,
-)
+from sqc.metrics import DEDUP_SAVED_INVOCATIONS
+from sqc.validation.columns import ColumnarModel, ColumnarResult
+from sqc.validation.io import fingerprint_model, load_structure
+from sqc.validation.model import Progress, Status
 from sqc.validation.molprobity import MolProbity, MolProbityError
+from sqc.validation.timeouts import timeout_policy
+from sqc.validation.versions import molprobity_versions
 
 logger = get_logger()
 
+# tool runs of a single model, residue-analysis and clashscore
+RUNS_PER_MODEL = 2
+
 
 class ValidationError(Exception):
     def __init__(self, *args) -> None:
         super().__init__(*args)
 
 
-def validate(path: str, filename: str) -> str:
-    logger.debug(f"Starting validation of {path}")
-    pdb_id = get_pdb_id(path) or "unknown_pdb_id"
-    model_paths = split_models(path)
-    output_models = []
-    mp = MolProbity()
+class _ModelResults:
+    """
+    Results of the validated models, filled in as their tool runs finish.
+    After every run but the last one, the results so far are passed to
+    `on_progress` as a partial result.
+    """
+
+    def __init__(
+        self,
+        mp: MolProbity,
+        status: Status,
+        pdb_id: str,
+        filename: str,
+        model_paths: list[tuple[int, str]],
+        duplicates: dict[int, int],
+        on_progress: Callable[[ColumnarResult], None] | None,
+    ) -> None:
+        self.mp = mp
+        self.status = status
+        self.pdb_id = pdb_id
+        self.filename = filename
+        self.models = {
+            model_num: ColumnarModel(number=model_num) for model_num, _ in model_paths
+        }
+        self.duplicates = duplicates
+        self.on_progress = on_progress
+        self.finished_runs = {model_num: 0 for model_num in self.models}
+
+    def run_finished(self, model_num: int) -> None:
+        self.finished_runs[model_num] += 1
+
+        completed_runs = sum(self.finished_runs.values())
+        total_runs = RUNS_PER_MODEL * len(self.models)
+        if self.on_progress is None or completed_runs == total_runs:
+            return
+
+        completed = {
+            model_num
+            for model_num, runs in self.finished_runs.items()
+            if runs == RUNS_PER_MODEL
+        }
+        progress = Progress(
+            models=len(self.models) + len(self.duplicates),
+            completed_models=len(completed)
+            + sum(1 for original in self.duplicates.values() if original in completed),
+            completed_runs=completed_runs,
+            total_runs=total_runs,
+        )
+        status = self.status.model_copy(update={"progress": progress})
+        self.on_progress(
+            self._result(
+                status,
+                [
+                    model
+                    for model_num, model in self.models.items()
+                    if self.finished_runs[model_num] > 0
+                ],
+            )
+        )
+
+    def result(self) -> ColumnarResult:
+        return self._result(self.status, list(self.models.values()))
+
+    def _result(self, status: Status, models: list[ColumnarModel]) -> ColumnarResult:
+        """Adds the duplicates of `models` and orders them by their number"""
+        validated = {model.number: model for model in models}
+        for model_num, original_num in self.duplicates.items():
+            if original_num in validated:
+                models.append(
+                    dataclasses.replace(validated[original_num], number=model_num)
+                )
+        models.sort(key=lambda model: model.number)
+
+        return ColumnarResult(
+            status=status, pdb_id=self.pdb_id, filename=self.filename, models=models
+        )
+
+
+def _validate_model(
+    mp: MolProbity,
+    model_num: int,
+    model_path: str,
+    atoms: int,
+    results: _ModelResults,
+) -> None:
+    model = results.models[model_num]
+
+    try:
+        model.residues = mp.residue_analysis(model_path, atoms)
+    except MolProbityError:
+        results.status.residue_analysis = False
+    results.run_finished(model_num)
+
+    try:
+        model.clashes = mp.clashscore(model_path, atoms)
+    except MolProbityError:
+        results.status.clashscore = False
+    results.run_finished(model_num)
+
+
+def _validate_models_concurrently(
+    mp: MolProbity,
+    model_paths: list[tuple[int, str]],
+    atoms: int,
+    results: _ModelResults,
+    jobs: int,
+) -> None:
+    """
+    Fans the MolProbity tool runs of all models out to at most `jobs`
+    concurrent subprocesses and collects their results as they finish
+    """
+    executor = ThreadPoolExecutor(max_workers=_concurrent_runs(model_paths, jobs))
+    pending: dict[Future, tuple[int, str]] = {}
+
+    try:
+        for model_num, model_path in model_paths:
+            # in the context of the request, so that its tool runs are timed
+            residues = executor.submit(
+                contextvars.copy_context().run, mp.residue_analysis, model_path, atoms
+            )
+            clashes = executor.submit(
+                contextvars.copy_context().run, mp.clashscore, model_path, atoms
+            )
+            pending[residues] = (model_num, "residue-analysis")
+            pending[clashes] = (model_num, "clashscore")
+
+        for future in as_completed(pending):
+            model_num, tool = pending[future]
+            model = results.models[model_num]
 
-    status = Status(molprobity_versions=mp.get_data_versions())
+            if tool == "residue-analysis":
+                try:
+                    model.residues = future.result()
+                except MolProbityError:
+                    results.status.residue_analysis = False
+            else:
+                try:
+                    model.clashes = future.result()
+                except MolProbityError:
+                    results.status.clashscore = False
+
+            results.run_finished(model_num)
+    finally:
+        # do not start tools of the remaining models if one of them failed
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _concurrent_runs(model_paths: list[tuple[int, str]], jobs: int) -> int:
+    return max(1, min(jobs, RUNS_PER_MODEL * len(model_paths)))
+
+
+def _deduplicate_models(
+    model_paths: list[tuple[int, str]],
+) -> tuple[list[tuple[int, str]], dict[int, int]]:
+    """
+    Finds models with identical coordinates. Returns the models that need to
+    be validated and a mapping of duplicate model numbers to the number of the
+    model whose results they share.
+    """
+    unique_models: list[tuple[int, str]] = []
+    duplicates: dict[int, int] = {}
+    seen: dict[str, int] = {}
 
     for model_num, model_path in model_paths:
-        model = Model(number=model_num)
+        fingerprint = fingerprint_model(model_path)
+        if fingerprint in seen:
+            duplicates[model_num] = seen[fingerprint]
+        else:
+            seen[fingerprint] = model_num
+            unique_models.append((model_num, model_path))
+
+    return unique_models, duplicates
+
+
+def validate_structure(
+    path: str,
+    filename: str,
+    jobs: int = 1,
+    on_progress: Callable[[ColumnarResult], None] | None = None,
+) -> ColumnarResult:
+    """
+    Validates the structure at `path` using MolProbity.
+
+    `jobs` caps the number of MolProbity subprocesses this request may run at
+    once. With more than one job, residue-analysis and clashscore of all
+    models are scheduled concurrently.
 
-        try:
-            model.residues = mp.residue_analysis(model_path)
-        except MolProbityError:
-            status.residue_analysis = False
+    `on_progress` is called with a partial result, see `Progress`, whenever
+    a tool run finishes before the validation is complete.
+    """
+    logger.debug(f"Starting validation of {path}")
+    structure = load_structure(path)
+    model_paths = structure.models
+
+    status = Status(molprobity_versions=molprobity_versions.get())
+
+    # the timeouts of the tool runs scale with the atoms of a model, files
+    # without any models get an empty result
+    atoms = structure.atoms // max(len(model_paths), 1)
 
-        try:
-            model.clashes = mp.clashscore(model_path)
-        except MolProbityError:
-            status.clashscore = False
+    duplicates: dict[int, int] = {}
+    if len(model_paths) > 1:
+        model_paths, duplicates = _deduplicate_models(model_paths)
 
-        output_models.append(model)
+    if jobs > 1:
+        mp = MolProbity(
+            policy=timeout_policy, concurrent_runs=_concurrent_runs(model_paths, jobs)
+        )
+    else:
+        mp = MolProbity(policy=timeout_policy)
 
-    result = Result(
-        status=status, filename=filename, pdb_id=pdb_id, models=output_models
+    results = _ModelResults(
+        mp, status, structure.pdb_id, filename, model_paths, duplicates, on_progress
     )
-    return result.model_dump_json(exclude_none=True)
+
+    if jobs > 1:
+        _validate_models_concurrently(mp, model_paths, atoms, results, jobs)
+    else:
+        for model_num, model_path in model_paths:
+            _validate_model(mp, model_num, model_path, atoms, results)
+
+    if duplicates:
+        # each skipped model saves a residue-analysis and a clashscore run
+        saved_invocations = RUNS_PER_MODEL * len(duplicates)
+        DEDUP_SAVED_INVOCATIONS.inc(saved_invocations)
+        logger.info(
+            "Reused results of duplicate models",
+            duplicate_models=len(duplicates),
+            saved_invocations=saved_invocations,
+        )
+
+    result = results.result()
+    result.applied_timeout = mp.applied_timeout
+
+    return result
+
+
+def validate(path: str, filename: str, jobs: int = 1) -> str:
+    return validate_structure(path, filename, jobs).to_json()
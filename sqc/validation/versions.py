@@ -0,0 +1,113 @@
+import os
+import threading
+
+from structlog import get_logger
+import git
+
+from sqc.validation.model import DataVersion, MolProbityVersions
+
+logger = get_logger()
+
+
+class VersionsRegistry:
+    """
+    Process-wide registry of the MolProbity data versions shared by all worker
+    threads. The versions are read once from the data repositories, or from a
+    pre-baked manifest so that git is not needed at runtime, and are only
+    reloaded on an explicit refresh.
+    """
+
+    REPO_PATHS = {
+        "geostd_version": "/molprobity/modules/chem_data/geostd",
+        "mon_lib_version": "/molprobity/modules/chem_data/mon_lib",
+        "rotarama_version": "/molprobity/modules/chem_data/rotarama_data",
+        "cablam_version": "/molprobity/modules/chem_data/cablam_data",
+        "rama_z_version": "/molprobity/modules/chem_data/rama_z",
+    }
+
+    def __init__(self, manifest_path: str | None = None) -> None:
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self._versions: MolProbityVersions | None = None
+        self._mtime: float | None = None
+
+    @staticmethod
+    def _get_data_version(path: str) -> DataVersion:
+        repo = git.Repo(path)
+        try:
+            return DataVersion(url=repo.remote().url, commit_sha=repo.commit().hexsha)
+        finally:
+            repo.close()
+
+    def _uses_manifest(self) -> bool:
+        return self.manifest_path is not None and os.path.exists(self.manifest_path)
+
+    def _sources_mtime(self) -> float:
+        """Last modification time of the files the versions are read from"""
+        if self._uses_manifest():
+            assert self.manifest_path is not None
+            return os.path.getmtime(self.manifest_path)
+
+        mtime = 0.0
+        for path in self.REPO_PATHS.values():
+            for name in ("HEAD", "packed-refs", "refs/heads"):
+                try:
+                    mtime = max(mtime, os.path.getmtime(f"{path}/.git/{name}"))
+                except FileNotFoundError:
+                    pass
+
+        return mtime
+
+    def _load(self) -> MolProbityVersions:
+        if self._uses_manifest():
+            assert self.manifest_path is not None
+            with open(self.manifest_path, "r") as manifest:
+                return MolProbityVersions.model_validate_json(manifest.read())
+
+        return MolProbityVersions(
+            **{
+                name: self._get_data_version(path)
+                for name, path in self.REPO_PATHS.items()
+            }
+        )
+
+    def get(self) -> MolProbityVersions:
+        versions = self._versions
+        if versions is not None:
+            return versions
+
+        with self._lock:
+            if self._versions is None:
+                self._refresh()
+            assert self._versions is not None
+            return self._versions
+
+    def refresh(self) -> MolProbityVersions:
+        with self._lock:
+            try:
+                return self._refresh()
+            except Exception:
+                if self._versions is None:
+                    raise
+
+                logger.exception("Failed to reload MolProbity data versions")
+                return self._versions
+
+    def _refresh(self) -> MolProbityVersions:
+        mtime = self._sources_mtime()
+        self._versions = self._load()
+        self._mtime = mtime
+        logger.info("Loaded MolProbity data versions", manifest=self._uses_manifest())
+        return self._versions
+
+    def refresh_if_changed(self) -> None:
+        """Reloads the versions if their sources were modified since loading"""
+        if self._mtime is not None and self._sources_mtime() != self._mtime:
+            self.refresh()
+
+
+molprobity_versions = VersionsRegistry(os.environ.get("MOLPROBITY_VERSIONS_MANIFEST"))
+
+
+def print_versions_manifest():
+    print(VersionsRegistry()._load().model_dump_json())
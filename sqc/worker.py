@@ -1,33 +1,166 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import functools
 import os
-from typing import Any
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Callable
 
 from structlog import get_logger
 import structlog
-from kombu import Connection, Exchange, Queue
+from kombu import Connection, Exchange, Producer, Queue
 from kombu.mixins import ConsumerMixin
 
-from sqc.repository import ConversionError, InternalError, MinioRepo, SQCResponse
-from sqc.validation import ValidationError, validate
+from sqc.cache import ResultCache, cache_key
+from sqc.metrics import IN_FLIGHT, REQUESTS, collect_timings, observe_stage
+from sqc.pipeline import Job, Pipeline, Stage
+from sqc.repository import (
+    ConversionError,
+    InternalError,
+    MinioRepo,
+    SQCResponse,
+    StorageUnavailable,
+)
+from sqc.resilience import storage_breaker
+from sqc.validation import ValidationError, validate_structure
+from sqc.validation.columns import ColumnarResult, replace_filename
+from sqc.validation.timeouts import timeout_policy
+from sqc.validation.validation import RUNS_PER_MODEL
+from sqc.validation.versions import molprobity_versions
+from sqc.workspace import Workspace
 
 logger = get_logger()
 
 
+def rabbit_connection() -> Connection:
+    rabbit_user = os.environ.get("RABBITMQ_USER", "guest")
+    rabbit_password = os.environ.get("RABBITMQ_PASSWORD", "guest")
+    rabbit_url = os.environ.get("RABBITMQ_URL", "rabbitmq:5672")
+    return Connection(f"amqp://{rabbit_user}:{rabbit_password}@{rabbit_url}//")
+
+
 class Worker(ConsumerMixin):
     queue = Queue("requests", Exchange("requests", type="fanout", durable=True), "#")
+    dead_letter_queue = Queue(
+        "requests.dead", Exchange("requests.dead", type="fanout", durable=True), "#"
+    )
+
+    # number of times a message has been redelivered, see _check_redelivery
+    REDELIVERIES_HEADER = "x-sqc-redeliveries"
 
-    def __init__(self, repo: MinioRepo) -> None:
-        rabbit_user = os.environ.get("RABBITMQ_USER", "guest")
-        rabbit_password = os.environ.get("RABBITMQ_PASSWORD", "guest")
-        rabbit_url = os.environ.get("RABBITMQ_URL", "rabbitmq:5672")
-        rabbit_conn = f"amqp://{rabbit_user}:{rabbit_password}@{rabbit_url}//"
-        self.connection = Connection(rabbit_conn)
+    def __init__(
+        self,
+        repo: MinioRepo,
+        cache: ResultCache | None = None,
+        request_queue: Queue | None = None,
+    ) -> None:
+        self.connection = rabbit_connection()
+        if request_queue is not None:
+            self.queue = request_queue
         self.repo = repo
+        self.cache = cache
+        self.molprobity_jobs = self._molprobity_jobs()
+        self.prefetch_count = int(os.environ.get("PREFETCH_COUNT", 1))
+        # "late" acks messages only after their response has been written
+        self.late_ack = os.environ.get("ACK_MODE", "early") == "late"
+        if self.late_ack:
+            self._check_consumer_timeout()
+        self.max_redeliveries = int(os.environ.get("MAX_REDELIVERIES", 3))
+        # long validations publish what they have so far every interval
+        self.partial_results = os.environ.get("PARTIAL_RESULTS", "off") == "on"
+        self.partial_interval = float(os.environ.get("PARTIAL_RESULTS_INTERVAL", 10))
+
+        self.stages = self._stages()
+        self.pipeline: Pipeline | None = None
+        if os.environ.get("PIPELINE", "off") == "on":
+            self.pipeline = Pipeline(
+                self.stages, int(os.environ.get("PIPELINE_QUEUE_SIZE", 1))
+            )
+
+    @staticmethod
+    def _check_consumer_timeout() -> None:
+        """
+        RabbitMQ closes the channel of a consumer that keeps a message unacked
+        longer than its consumer_timeout (30 minutes by default) and redelivers
+        the message, so late acks need it above the longest request.
+        RABBITMQ_CONSUMER_TIMEOUT mirrors the broker setting in seconds. The
+        MolProbity timeouts are capped so that both runs of a model fit in it.
+        """
+        consumer_timeout = float(os.environ.get("RABBITMQ_CONSUMER_TIMEOUT", 1800))
+        limit = consumer_timeout / RUNS_PER_MODEL
+        if timeout_policy.maximum > limit or timeout_policy.fixed > limit:
+            logger.warning(
+                "Capping MolProbity timeouts below the RabbitMQ consumer timeout",
+                consumer_timeout=consumer_timeout,
+                max_tool_timeout=limit,
+            )
+            timeout_policy.limit(limit)
+
+    @staticmethod
+    def _molprobity_jobs() -> int:
+        """Number of MolProbity subprocesses a single request may run at once"""
+        jobs = os.environ.get("MOLPROBITY_JOBS", "1")
+        if jobs == "auto":
+            return os.cpu_count() or 1
+
+        return max(int(jobs), 1)
 
     def get_consumers(self, consumer, _):
-        return [consumer(queues=[self.queue], callbacks=[self.on_message], prefetch_count=1)]
+        return [
+            consumer(
+                queues=[self.queue],
+                callbacks=[self.on_message],
+                prefetch_count=self.prefetch_count,
+            )
+        ]
+
+    def _check_redelivery(self, body: dict[str, Any], message, request: str) -> bool:
+        """
+        Handles a message redelivered after a crash or a failed response write.
+        RabbitMQ does not count redeliveries, so the message is republished
+        with an incremented counter header, or moved to the dead-letter queue
+        once it exceeds MAX_REDELIVERIES. Returns whether the message should
+        be processed.
+        """
+        if not message.delivery_info.get("redelivered"):
+            return True
+
+        redeliveries = int((message.headers or {}).get(self.REDELIVERIES_HEADER, 0)) + 1
+        producer = Producer(message.channel)
+
+        if redeliveries > self.max_redeliveries:
+            logger.error("Request redelivered too many times, dead-lettering it")
+            producer.publish(
+                body,
+                exchange=self.dead_letter_queue.exchange,
+                declare=[self.dead_letter_queue],
+                headers={self.REDELIVERIES_HEADER: redeliveries},
+                serializer="json",
+            )
+            self.repo.write_response(
+                request,
+                SQCResponse.err(f"An internal error occured, request id: {request}"),
+            )
+        else:
+            logger.warning("Request was redelivered", redeliveries=redeliveries)
+            producer.publish(
+                body,
+                exchange="",
+                routing_key=self.queue.name,
+                headers={self.REDELIVERIES_HEADER: redeliveries},
+                serializer="json",
+            )
 
-    def on_message(self, body: dict[str, Any], message) -> None:
         message.ack()
+        return False
+
+    def on_message(self, body: dict[str, Any], message) -> None:
+        # pause consumption while MinIO is down rather than fail the requests
+        storage_breaker.wait(lambda: self.should_stop)
+
+        if not self.late_ack:
+            message.ack()
         structlog.contextvars.clear_contextvars()
 
         if (event_name := body["EventName"]) not in {
@@ -37,30 +170,276 @@ class Worker(ConsumerMixin):
             logger.warning(
                 f"Invalid event name, dropping message", event_name=event_name
             )
+            if self.late_ack:
+                message.ack()
             return
 
         request = body["Records"][0]["s3"]["object"]["key"]
         structlog.contextvars.bind_contextvars(request_id=request)
+
+        if self.late_ack and not self._check_redelivery(body, message, request):
+            return
+
         logger.info("Got new request")
 
-        resp: SQCResponse | None = None
+        job = Job(request, message)
+        IN_FLIGHT.labels(threading.current_thread().name).inc()
+        self._observe_queue_wait(job, body)
+
+        if self.pipeline is not None:
+            self.pipeline.submit(job)
+            return
+
+        for stage in self.stages:
+            stage.run(job)
+        self._finish(job)
+
+    @staticmethod
+    def _observe_queue_wait(job: Job, body: dict[str, Any]) -> None:
+        """Time between the upload of the request and its consumption"""
         try:
-            path, filename = self.repo.download_request(request)
-            result = validate(path, filename)
-            resp = SQCResponse.ok(result)
-        except (ValidationError, ConversionError) as err:
-            resp = SQCResponse.err(str(err))
-        except InternalError as err:
-            resp = SQCResponse.err(f"An internal error occured, request id: {request}")
-        except Exception as err:
-            logger.exception(err)
-            resp = SQCResponse.err(f"An internal error occured, request id: {request}")
-        finally:
-            if resp:
-                self.repo.write_response(request, resp)
+            uploaded = datetime.fromisoformat(body["Records"][0]["eventTime"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+
+        wait = (datetime.now(timezone.utc) - uploaded).total_seconds()
+        with collect_timings(job.timings):
+            observe_stage("queue_wait", max(wait, 0.0))
+
+    def _stages(self) -> list[Stage]:
+        return [
+            Stage(
+                "fetch",
+                self._stage_threads("FETCH"),
+                self._timed(self._guarded(self._fetch)),
+            ),
+            Stage(
+                "convert",
+                self._stage_threads("CONVERT"),
+                self._timed(self._guarded(self._convert)),
+            ),
+            Stage(
+                "validate",
+                self._stage_threads("VALIDATE"),
+                self._timed(self._guarded(self._validate)),
+            ),
+            Stage("upload", self._stage_threads("UPLOAD"), self._timed(self._respond)),
+        ]
+
+    @staticmethod
+    def _timed(step: Callable[[Job], None]) -> Callable[[Job], None]:
+        """Collects the stage timings of the step into the timings of the job"""
+
+        @functools.wraps(step)
+        def run(job: Job) -> None:
+            with collect_timings(job.timings):
+                step(job)
+
+        return run
+
+    @staticmethod
+    def _stage_threads(stage: str) -> int:
+        return int(os.environ.get(f"PIPELINE_{stage}_THREADS", 1))
+
+    def _guarded(self, step: Callable[[Job], None]) -> Callable[[Job], None]:
+        """
+        Skips the step for jobs that already have a response and turns errors
+        of the step into error responses
+        """
+
+        @functools.wraps(step)
+        def run(job: Job) -> None:
+            if job.response is not None or job.retry_later:
+                return
+
+            request = job.request
+            try:
+                step(job)
+            except (ValidationError, ConversionError) as err:
+                job.response = SQCResponse.err(str(err))
+                job.outcome = (
+                    "validation_error"
+                    if isinstance(err, ValidationError)
+                    else "conversion_error"
+                )
+            except StorageUnavailable:
+                job.retry_later = True
+                job.outcome = "storage_unavailable"
+            except InternalError as err:
+                job.outcome = "internal_error"
+                job.response = SQCResponse.err(
+                    f"An internal error occured, request id: {request}"
+                )
+            except Exception as err:
+                logger.exception(err)
+                job.outcome = "internal_error"
+                job.response = SQCResponse.err(
+                    f"An internal error occured, request id: {request}"
+                )
+
+        return run
+
+    def _fetch(self, job: Job) -> None:
+        """Downloads the request and looks its result up in the cache"""
+        job.workspace = Workspace()
+        job.path, job.ftype, job.filename = self.repo.fetch_request(
+            job.request, job.workspace.path
+        )
+
+        if self.cache is not None:
+            job.cache_key = cache_key(job.path, job.ftype, molprobity_versions.get())
+            if (cached := self.cache.get(job.cache_key)) is not None:
+                logger.info("Using cached result", cache_key=job.cache_key)
+                job.outcome = "cached"
+                job.response = SQCResponse.ok(replace_filename(cached, job.filename))
+
+    def _convert(self, job: Job) -> None:
+        assert job.path is not None and job.ftype is not None
+        job.path = MinioRepo.ensure_pdb(job.path, job.ftype)
+
+    def _validate(self, job: Job) -> None:
+        assert job.path is not None and job.filename is not None
+        on_progress = self._partial_writer(job) if self.partial_results else None
+        result = validate_structure(
+            job.path, job.filename, self.molprobity_jobs, on_progress
+        )
+        job.applied_timeout = result.applied_timeout
+
+        # results of timed out tools are not worth reusing
+        job.cacheable = result.status.residue_analysis and result.status.clashscore
+
+        if self.cache is not None and job.cacheable:
+            # serialized once for both the cache and the upload
+            job.response = SQCResponse.ok(result.to_json())
+        else:
+            job.response = SQCResponse.ok_stream(result.iter_json)
+
+    def _partial_writer(self, job: Job) -> Callable[[ColumnarResult], None]:
+        """
+        Writes partial results of the job, at most one every
+        PARTIAL_RESULTS_INTERVAL seconds. Validations finishing within the
+        interval write none.
+        """
+        last_write = perf_counter()
+
+        def write(result: ColumnarResult) -> None:
+            nonlocal last_write
+            if perf_counter() - last_write < self.partial_interval:
+                return
+
+            assert result.status.progress is not None
+            logger.info(
+                "Writing partial result",
+                completed_runs=result.status.progress.completed_runs,
+                total_runs=result.status.progress.total_runs,
+            )
+            if self.repo.write_partial(job.request, result.iter_json):
+                job.partial_written = True
+            last_write = perf_counter()
+
+        return write
+
+    def _respond(self, job: Job) -> None:
+        """
+        Writes the response of the job, caches its result and removes the
+        workspace of the request
+        """
+        try:
+            if job.retry_later:
+                return
+
+            if job.response:
+                job.written = self.repo.write_response(
+                    job.request,
+                    job.response,
+                    job.timings.snapshot(),
+                    job.applied_timeout,
+                )
+                if not job.written and storage_breaker.is_open():
+                    job.retry_later = True
+                    job.outcome = "storage_unavailable"
+                elif job.written and job.partial_written:
+                    # the response replaces the partial result
+                    self.repo.delete_partial(job.request)
             else:
                 logger.error("SQC response is None")
 
+            if self.cache is not None and job.cacheable:
+                assert job.cache_key is not None and job.response is not None
+                try:
+                    self.cache.put(job.cache_key, "".join(job.response.result_chunks()))
+                except OSError:
+                    logger.exception("Failed to cache result", cache_key=job.cache_key)
+        finally:
+            if job.workspace is not None:
+                job.workspace.cleanup()
+
+    def _retry_later(self, job: Job) -> None:
+        """
+        Puts the message of a job that failed on unavailable storage back on
+        the queue. It is republished rather than requeued, so that it does not
+        count as a redelivery.
+        """
+        logger.warning("MinIO is unavailable, requeueing request")
+        Producer(job.message.channel).publish(
+            job.message.payload,
+            exchange="",
+            routing_key=self.queue.name,
+            headers=job.message.headers,
+            serializer="json",
+        )
+        if self.late_ack:
+            job.message.ack()
+
+    def _finish(self, job: Job) -> None:
+        """
+        Acknowledges the message of a finished job and records its metrics (on
+        the consumer thread)
+        """
+        IN_FLIGHT.labels(threading.current_thread().name).dec()
+        REQUESTS.labels(job.outcome).inc()
+        observe_stage("request", perf_counter() - job.started)
+
+        if job.retry_later:
+            try:
+                self._retry_later(job)
+            except Exception:
+                logger.exception("Failed to requeue message", request_id=job.request)
+            return
+
+        if not self.late_ack:
+            return
+
+        try:
+            if job.written:
+                job.message.ack()
+            else:
+                # redelivered later, counting towards MAX_REDELIVERIES
+                job.message.requeue()
+        except Exception:
+            logger.exception("Failed to acknowledge message", request_id=job.request)
+
+    def _finish_completed(self) -> None:
+        assert self.pipeline is not None
+        while True:
+            try:
+                job = self.pipeline.completed.get_nowait()
+            except queue.Empty:
+                return
+            self._finish(job)
+
+    def on_iteration(self) -> None:
+        if self.pipeline is not None:
+            self._finish_completed()
+
+    @contextmanager
+    def extra_context(self, connection, channel):
+        yield
+        # acknowledge the jobs in flight while the channel is still open
+        if self.pipeline is not None and self.should_stop:
+            self.pipeline.join()
+            self._finish_completed()
+
     def run(self, *args, **kwargs) -> None:
         while not self.should_stop:
             try:
@@ -68,4 +447,6 @@ class Worker(ConsumerMixin):
             except Exception:
                 logger.exception("Worker shut down because of an exception")
 
+        if self.pipeline is not None:
+            self.pipeline.close()
         self.connection.release()
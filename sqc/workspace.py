@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+
+from structlog import get_logger
+
+from sqc.metrics import SCRATCH_FREE_BYTES, WORKSPACE_BYTES
+
+logger = get_logger()
+
+# workspaces are named sqc-<pid>-<random>, see sweep_orphaned_workspaces
+PREFIX = "sqc-"
+
+
+def scratch_root() -> str:
+    """
+    Directory holding the request workspaces, set by SCRATCH_DIR. Best put on
+    a tmpfs (e.g. /dev/shm or a memory-backed emptyDir) private to the pod.
+    """
+    root = os.environ.get("SCRATCH_DIR", tempfile.gettempdir())
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+def _disk_usage(path: str) -> int:
+    usage = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                usage += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+
+    return usage
+
+
+class Workspace:
+    """
+    Scratch directory of a single request. The request file, its PDB
+    conversion and the model splits are all written into it and removed
+    together by `cleanup`.
+    """
+
+    def __init__(self, root: str | None = None) -> None:
+        self.root = root if root is not None else scratch_root()
+        self.path = tempfile.mkdtemp(prefix=f"{PREFIX}{os.getpid()}-", dir=self.root)
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.cleanup()
+
+    def disk_usage(self) -> int:
+        """Bytes taken by the files in the workspace"""
+        return _disk_usage(self.path)
+
+    def cleanup(self) -> None:
+        if not os.path.isdir(self.path):
+            return
+
+        usage = self.disk_usage()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        scratch = shutil.disk_usage(self.root)
+        WORKSPACE_BYTES.observe(usage)
+        SCRATCH_FREE_BYTES.set(scratch.free)
+        logger.debug(
+            "Removed workspace",
+            workspace_bytes=usage,
+            scratch_used_bytes=scratch.used,
+            scratch_free_bytes=scratch.free,
+        )
+
+
+def _owner_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        # left behind by an earlier process with the same pid
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def sweep_orphaned_workspaces(root: str | None = None) -> int:
+    """
+    Removes workspaces of processes that are no longer running, e.g. after a
+    worker crashed or was killed mid-request. Must run before this process
+    creates workspaces of its own. Returns the number of bytes freed.
+    """
+    root = root if root is not None else scratch_root()
+    removed = 0
+    freed = 0
+
+    with os.scandir(root) as it:
+        for entry in it:
+            if not entry.name.startswith(PREFIX) or not entry.is_dir():
+                continue
+
+            try:
+                pid = int(entry.name[len(PREFIX) :].split("-", 1)[0])
+            except ValueError:
+                continue
+
+            if _owner_alive(pid):
+                continue
+
+            freed += _disk_usage(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+
+    if removed:
+        logger.warning(
+            "Removed orphaned workspaces", workspaces=removed, freed_bytes=freed
+        )
+
+    return freed
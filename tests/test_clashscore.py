@@ -0,0 +1,158 @@
+import io
+import json
+import os
+from typing import Iterator
+
+import pytest
+
+from sqc.validation.molprobity import MolProbity
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+class FixtureEngine:
+    """Replays a clashscore output instead of running MolProbity"""
+
+    def __init__(self, output: str) -> None:
+        self.output = output
+
+    def stream(self, args: list[str], timeout: float) -> Iterator[str]:
+        return io.StringIO(self.output)
+
+
+def read_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), "r") as file:
+        return file.read()
+
+
+def clashscore(output: str):
+    return MolProbity(engine=FixtureEngine(output)).clashscore("model.pdb")
+
+
+def clash_rows(output: str) -> list[dict]:
+    return json.loads(clashscore(output).to_json())
+
+
+def atom(chain: str, number: int, name: str, insertion_code: str | None = None):
+    result = {"residue_number": number, "chain": chain, "atom": name}
+    if insertion_code is not None:
+        result["insertion_code"] = insertion_code
+    return result
+
+
+def test_probe_style_lines():
+    rows = clash_rows(read_fixture("clashscore-probe.out"))
+
+    assert rows == [
+        {
+            "first_atom": atom("A", 20, "HD11"),
+            "second_atom": atom("A", 24, "HD12"),
+            "magnitude": 0.671,
+        },
+        {
+            "first_atom": atom("A", 72, "HG2"),
+            "second_atom": atom("B", 1034, "C"),
+            "magnitude": 0.816,
+        },
+        {
+            "first_atom": atom("AB", 12, "O", "A"),
+            "second_atom": atom("AB", 13, "N"),
+            "magnitude": 0.452,
+        },
+        {
+            "first_atom": atom("X", 1194, "OH"),
+            "second_atom": atom("X", 1195, "CB"),
+            "magnitude": 1.052,
+        },
+        {
+            "first_atom": atom("", 9, "CA"),
+            "second_atom": atom("", 11, "NH1"),
+            "magnitude": 0.612,
+        },
+        {
+            "first_atom": atom("1", 12, "O"),
+            "second_atom": atom("1", 1034, "OD1"),
+            "magnitude": 0.433,
+        },
+        {
+            "first_atom": atom("A", -123, "O"),
+            "second_atom": atom("A", 100, "OG", "B"),
+            "magnitude": 0.401,
+        },
+    ]
+
+
+def test_colon_separated_lines():
+    rows = clash_rows(read_fixture("clashscore-colon.out"))
+
+    assert rows == [
+        {
+            "first_atom": atom("A", 9, "CA"),
+            "second_atom": atom("B", 12, "O"),
+            "magnitude": -0.412,
+        },
+        {
+            "first_atom": atom("X", 1034, "C"),
+            "second_atom": atom("A", 11, "NH1"),
+            "magnitude": -0.612,
+        },
+        {
+            "first_atom": atom("A", 27, "HB2", "A"),
+            "second_atom": atom("A", 28, "H"),
+            "magnitude": 0.455,
+        },
+    ]
+
+
+@pytest.mark.parametrize(
+    "line, first, second",
+    [
+        # multi-character chain
+        (" AB  12  GLU  O    AB  13  LYS  N   :0.452", ("AB", 12), ("AB", 13)),
+        # digit chain, joined to a four digit residue number
+        (" 1  12  GLU  O    11034  ASP  OD1 :0.433", ("1", 12), ("1", 1034)),
+        # blank chain
+        ("    9  LYS  CA       11  ARG  NH1 :0.612", ("", 9), ("", 11)),
+        # letter chain joined to a four digit residue number
+        ("X1194  TYR  OH   X1195  ALA  CB  :1.052", ("X", 1194), ("X", 1195)),
+    ],
+)
+def test_chain_ids(line, first, second):
+    (row,) = clash_rows(f"Bad Clashes >= 0.4 Angstrom:\n{line}\nclashscore = 1.00\n")
+
+    first_atom, second_atom = row["first_atom"], row["second_atom"]
+    assert (first_atom["chain"], first_atom["residue_number"]) == first
+    assert (second_atom["chain"], second_atom["residue_number"]) == second
+
+
+@pytest.mark.parametrize(
+    "line, first, second",
+    [
+        (" A  12A GLU  O    A  13  LYS  N   :0.452", (12, "A"), (13, None)),
+        (" A 100B SER  OG  : A1034C ASP  OD1:0.5", (100, "B"), (1034, "C")),
+        (" B1034  ASP  C     B-123  HOH  O   :0.7", (1034, None), (-123, None)),
+    ],
+)
+def test_insertion_codes_and_joined_residue_numbers(line, first, second):
+    (row,) = clash_rows(f"{line}\n")
+
+    first_atom, second_atom = row["first_atom"], row["second_atom"]
+    assert (first_atom["residue_number"], first_atom.get("insertion_code")) == first
+    assert (second_atom["residue_number"], second_atom.get("insertion_code")) == second
+
+
+def test_summary_and_footer_lines():
+    clashes = clashscore(read_fixture("clashscore-colon.out"))
+
+    # header, blank and summary lines are not clashes
+    assert len(clashes.magnitude) == 3
+    assert clashes.clashscore == pytest.approx(12.34)
+
+
+def test_missing_summary():
+    clashes = clashscore(
+        "Bad Clashes >= 0.4 Angstrom:\n A  20  LEU HD11  A  24  ILE HD12 :0.671\n"
+    )
+
+    assert len(clashes.magnitude) == 1
+    assert clashes.clashscore is None
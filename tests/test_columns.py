@@ -0,0 +1,296 @@
+import math
+
+import pytest
+
+from sqc.validation.columns import (
+    CHUNK_ROWS,
+    ClashAtom,
+    ClashColumns,
+    ColumnarModel,
+    ColumnarResult,
+    ResidueColumns,
+    ResidueId,
+    replace_filename,
+)
+from sqc.validation.model import (
+    Atom,
+    Clash,
+    DataVersion,
+    Model,
+    MolProbityVersions,
+    OmegaTorsion,
+    Progress,
+    RamaTorsion,
+    Residue,
+    Result,
+    SidechainTorsion,
+    Status,
+    WorstBondAngle,
+    WorstBondLength,
+    WorstClash,
+)
+from sqc.validation.validation import _ModelResults
+
+# formatted differently by repr and by pydantic, or not at all by JSON
+FLOATS = [0.1, 1.0, -0.0, 2.5e-7, 1e-5, 1e16, 1.5e20, 123456789.123, math.inf]
+
+STRINGS = ["A", "", "é", '"', "\\", "\t", "✓"]
+
+
+def versions() -> MolProbityVersions:
+    version = DataVersion(url="https://example.org/data.git", commit_sha="0" * 40)
+    return MolProbityVersions(
+        geostd_version=version,
+        mon_lib_version=version,
+        rotarama_version=version,
+        cablam_version=version,
+        rama_z_version=version,
+    )
+
+
+def residue_id(i: int) -> ResidueId:
+    return ResidueId(
+        number=i - 5,
+        chain=STRINGS[i % len(STRINGS)],
+        residue_type="LYS",
+        alt_code="B" if i % 3 == 0 else None,
+    )
+
+
+def residue_rows(count: int) -> list[dict]:
+    """Residues with every combination of present and absent fields"""
+    rows = []
+    for i in range(count):
+        value = FLOATS[i % len(FLOATS)]
+        rows.append(
+            {
+                "residue": residue_id(i),
+                "worst_clash": (
+                    (value, "CA", STRINGS[i % len(STRINGS)], residue_id(i + 1))
+                    if i % 2 == 0
+                    else None
+                ),
+                "worst_length": ((i, "CA", "C", value, -value) if i % 3 == 1 else None),
+                "worst_angle": (
+                    (i, "N", "CA", "C", value, 5.25) if i % 4 == 1 else None
+                ),
+                "omega": ("Twisted", -value) if i % 5 == 2 else None,
+                "rama": "OUTLIER" if i % 2 == 1 else None,
+                "sidechain": ("OUTLIER", "mtmt") if i % 7 == 3 else None,
+            }
+        )
+    return rows
+
+
+def pydantic_residue(row: dict) -> Residue:
+    def residue(residue_id: ResidueId) -> Residue:
+        return Residue(**residue_id._asdict())
+
+    result = residue(row["residue"])
+    if (clash := row["worst_clash"]) is not None:
+        result.worst_clash = WorstClash(
+            magnitude=clash[0],
+            atom=clash[1],
+            other_atom=clash[2],
+            other_residue=residue(clash[3]),
+        )
+    if (length := row["worst_length"]) is not None:
+        result.bond_length_outlier_count = length[0]
+        result.worst_bond_length = WorstBondLength(
+            first_atom=length[1],
+            second_atom=length[2],
+            length=length[3],
+            sigma=length[4],
+        )
+    if (angle := row["worst_angle"]) is not None:
+        result.bond_angle_outlier_count = angle[0]
+        result.worst_bond_angle = WorstBondAngle(
+            first_atom=angle[1],
+            second_atom=angle[2],
+            third_atom=angle[3],
+            angle=angle[4],
+            sigma=angle[5],
+        )
+    if (omega := row["omega"]) is not None:
+        result.omega_torsion = OmegaTorsion(angle_range=omega[0], angle=omega[1])
+    if row["rama"] is not None:
+        result.rama_torsion = RamaTorsion(angle_combo_range=row["rama"])
+    if (sidechain := row["sidechain"]) is not None:
+        result.sidechain_torsion = SidechainTorsion(
+            angle_range=sidechain[0], rotamer=sidechain[1]
+        )
+
+    return result
+
+
+def columnar_residues(rows: list[dict]) -> ResidueColumns:
+    residues = ResidueColumns()
+    for row in rows:
+        residues.append(
+            row["residue"],
+            worst_clash=row["worst_clash"],
+            worst_length=row["worst_length"],
+            worst_angle=row["worst_angle"],
+            omega=row["omega"],
+            rama=row["rama"],
+            sidechain=row["sidechain"],
+        )
+    return residues
+
+
+def clash_rows(count: int) -> list[tuple[ClashAtom, ClashAtom, float]]:
+    return [
+        (
+            ClashAtom(i, STRINGS[i % len(STRINGS)], "HG2", "A" if i % 2 else None),
+            ClashAtom(-i, "B", STRINGS[i % len(STRINGS)], "Z" if i % 3 else None),
+            FLOATS[i % len(FLOATS)],
+        )
+        for i in range(count)
+    ]
+
+
+def pydantic_clash(first: ClashAtom, second: ClashAtom, magnitude: float) -> Clash:
+    return Clash(
+        first_atom=Atom(**first._asdict()),
+        second_atom=Atom(**second._asdict()),
+        magnitude=magnitude,
+    )
+
+
+def columnar_clashes(rows, clashscore: float | None) -> ClashColumns:
+    clashes = ClashColumns()
+    for row in rows:
+        clashes.append(*row)
+    clashes.clashscore = clashscore
+    return clashes
+
+
+def models(
+    number: int, residues: int | None, clashes: int | None, clashscore: float | None
+) -> tuple[Model, ColumnarModel]:
+    """The same model in both representations, None leaves the tool out"""
+    residue_list = residue_rows(residues) if residues is not None else None
+    clash_list = clash_rows(clashes) if clashes is not None else None
+
+    model = Model(
+        number=number,
+        residues=(
+            [pydantic_residue(row) for row in residue_list]
+            if residue_list is not None
+            else None
+        ),
+        clashes=(
+            [pydantic_clash(*row) for row in clash_list]
+            if clash_list is not None
+            else None
+        ),
+        clashscore=clashscore if clash_list is not None else None,
+    )
+    columnar = ColumnarModel(
+        number,
+        columnar_residues(residue_list) if residue_list is not None else None,
+        (columnar_clashes(clash_list, clashscore) if clash_list is not None else None),
+    )
+    return model, columnar
+
+
+def results(status: Status, filename: str, specs) -> tuple[Result, ColumnarResult]:
+    pairs = [models(*spec) for spec in specs]
+    return (
+        Result(
+            status=status,
+            pdb_id="1abc",
+            filename=filename,
+            models=[model for model, _ in pairs],
+        ),
+        ColumnarResult(
+            status=status,
+            pdb_id="1abc",
+            filename=filename,
+            models=[columnar for _, columnar in pairs],
+        ),
+    )
+
+
+STATUSES = [
+    Status(molprobity_versions=versions()),
+    Status(residue_analysis=False, molprobity_versions=versions()),
+    Status(
+        molprobity_versions=versions(),
+        progress=Progress(models=3, completed_models=1, completed_runs=3, total_runs=6),
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    "specs",
+    [
+        [(1, 40, 30, 12.34)],
+        # failed tools and a missing clashscore
+        [(1, None, 5, None), (2, 5, None, None), (3, None, None, None)],
+        # empty outputs
+        [(1, 0, 0, 0.0)],
+        # more rows than a single chunk
+        [(1, CHUNK_ROWS * 2 + 3, CHUNK_ROWS + 1, 1e-5)],
+        [],
+    ],
+    ids=["model", "missing", "empty", "chunks", "no-models"],
+)
+@pytest.mark.parametrize("status", STATUSES, ids=["ok", "failed", "partial"])
+def test_serializes_like_pydantic(specs, status):
+    result, columnar = results(status, "structure.pdb", specs)
+
+    expected = result.model_dump_json(exclude_none=True)
+    assert columnar.to_json() == expected
+    assert "".join(columnar.iter_json()) == expected
+
+
+@pytest.mark.parametrize(
+    "value", FLOATS + [-math.inf, math.nan, 5e-324, 1.7976931348623157e308]
+)
+def test_floats_like_pydantic(value):
+    result, columnar = results(STATUSES[0], "structure.pdb", [(1, None, 0, value)])
+
+    assert columnar.to_json() == result.model_dump_json(exclude_none=True)
+
+
+@pytest.mark.parametrize("filename", ["other.cif", 'we"ird\\name é.pdb', ""])
+def test_replace_filename(filename):
+    # a filename key inside the strings of the result must stay as it is
+    result, columnar = results(STATUSES[0], ',"filename":"x', [(1, 10, 10, 1.0)])
+    expected, _ = results(STATUSES[0], filename, [(1, 10, 10, 1.0)])
+
+    assert replace_filename(columnar.to_json(), filename) == expected.model_dump_json(
+        exclude_none=True
+    )
+
+
+def test_duplicate_models():
+    status = STATUSES[0]
+    result, columnar = results(status, "structure.pdb", [(1, 10, 10, 2.0)])
+    model_results = _ModelResults(
+        None,
+        status,
+        "1abc",
+        "structure.pdb",
+        [(1, "model-1.pdb"), (3, "model-3.pdb")],
+        duplicates={2: 1, 4: 3},
+        on_progress=None,
+    )
+    _, third = models(3, 4, 2, None)
+    model_results.models = {1: columnar.models[0], 3: third}
+
+    expected = Result(
+        status=status,
+        pdb_id="1abc",
+        filename="structure.pdb",
+        models=[
+            result.models[0],
+            result.models[0].model_copy(update={"number": 2}),
+            models(3, 4, 2, None)[0],
+            models(4, 4, 2, None)[0],
+        ],
+    )
+    assert model_results.result().to_json() == expected.model_dump_json(
+        exclude_none=True
+    )
@@ -0,0 +1,132 @@
+import os
+import shutil
+
+import pytest
+
+from sqc.validation.io import (
+    _load_structure_stream,
+    _load_structure_tree,
+    _UnsupportedRecords,
+    load_structure,
+)
+
+# Biopython warns about every record the edge cases are made of
+pytestmark = pytest.mark.filterwarnings("ignore::Bio.BiopythonWarning")
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture_lines(name: str) -> list[str]:
+    with open(os.path.join(FIXTURES, name), "r") as file:
+        return file.read().splitlines()
+
+
+def write_pdb(directory, name: str, lines: list[str]) -> str:
+    path = os.path.join(directory, name)
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+def split(load, directory, name: str, lines: list[str]):
+    """Splits a copy of the file in its own directory, returns the models"""
+    os.makedirs(os.path.join(directory, name))
+    path = write_pdb(os.path.join(directory, name), "structure.pdb", lines)
+    structure = load(path)
+
+    models = []
+    for serial_num, model_path in structure.models:
+        with open(model_path, "rb") as file:
+            models.append((serial_num, file.read()))
+
+    return structure.pdb_id, structure.atoms, models
+
+
+def assert_splits_like_biopython(tmp_path, lines: list[str]) -> None:
+    stream = split(_load_structure_stream, tmp_path, "stream", lines)
+    tree = split(_load_structure_tree, tmp_path, "tree", lines)
+
+    assert stream == tree
+
+
+def test_multimodel_file(tmp_path):
+    lines = fixture_lines("multimodel.pdb")
+    assert_splits_like_biopython(tmp_path, lines)
+
+    pdb_id, atoms, models = split(_load_structure_stream, tmp_path, "check", lines)
+    assert pdb_id == "1ABC"
+    assert atoms == 39
+    assert [serial_num for serial_num, _ in models] == [1, 2, 3]
+
+
+def test_blank_occupancy_and_bfactor(tmp_path):
+    lines = [
+        line[:54] + " " * 12 + line[66:] if line.startswith("ATOM") else line
+        for line in fixture_lines("multimodel.pdb")
+    ]
+    assert_splits_like_biopython(tmp_path, lines)
+
+
+def test_segment_ids(tmp_path):
+    lines = [
+        line[:72] + "SEG1" + line[76:] if line.startswith("HETATM") else line
+        for line in fixture_lines("multimodel.pdb")
+    ]
+    assert_splits_like_biopython(tmp_path, lines)
+
+
+def test_models_without_endmdl(tmp_path):
+    lines = [line for line in fixture_lines("multimodel.pdb") if line != "ENDMDL"]
+    assert_splits_like_biopython(tmp_path, lines)
+
+
+def test_single_model_file_is_used_as_is(tmp_path):
+    lines = [
+        line
+        for line in fixture_lines("multimodel.pdb")
+        if not line.startswith(("MODEL", "ENDMDL"))
+    ]
+    # the atoms of the first model only
+    lines = lines[: lines.index("TER") + 1] + ["END"]
+    path = write_pdb(tmp_path, "structure.pdb", lines)
+
+    structure = _load_structure_stream(path)
+
+    assert structure.models == [(1, path)]
+    assert structure.atoms == 13
+
+
+def alternate_locations(lines: list[str]) -> list[str]:
+    return [
+        line[:16] + "A" + line[17:] if line.startswith("ATOM") else line
+        for line in lines
+    ]
+
+
+@pytest.mark.parametrize(
+    "edit",
+    [
+        alternate_locations,
+        # atoms of a residue redefined after another one
+        lambda lines: lines[:4] + lines[6:7] + lines[4:6] + lines[7:],
+        # duplicate model serial numbers
+        lambda lines: [
+            line.replace("MODEL        2", "MODEL        1") for line in lines
+        ],
+    ],
+    ids=["altloc", "redefined-residue", "duplicate-model"],
+)
+def test_unsupported_records_fall_back_to_biopython(tmp_path, edit):
+    lines = edit(fixture_lines("multimodel.pdb"))
+    path = write_pdb(tmp_path, "structure.pdb", lines)
+
+    with pytest.raises(_UnsupportedRecords):
+        _load_structure_stream(path)
+
+    tree = split(_load_structure_tree, tmp_path, "tree", lines)
+    os.makedirs(tmp_path / "fallback")
+    shutil.copy(path, tmp_path / "fallback")
+    structure = load_structure(str(tmp_path / "fallback" / "structure.pdb"))
+    assert [serial_num for serial_num, _ in structure.models] == [
+        serial_num for serial_num, _ in tree[2]
+    ]
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from scripts import baseline
+from scripts.replay import ReplayEngine, synthetic_output
+from sqc.validation.molprobity import MolProbity
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+
+def baseline_json(output: bytes) -> str:
+    residues = baseline.residue_analysis(output.decode("utf-8"))
+    return f"[{','.join(r.model_dump_json(exclude_none=True) for r in residues)}]"
+
+
+def streaming_json(output: bytes) -> str:
+    mp = MolProbity(engine=ReplayEngine({"residue-analysis": output}))
+    return mp.residue_analysis("model.pdb").to_json()
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        read_fixture("residue-analysis.out"),
+        synthetic_output(1_000),
+        # chains past the 9999th residue
+        synthetic_output(25_000),
+    ],
+    ids=["fixture", "synthetic", "synthetic-chains"],
+)
+def test_streaming_parser_matches_baseline(output):
+    assert streaming_json(output) == baseline_json(output)
+
+
+def test_residues_without_outliers_are_skipped():
+    # the fixture has a residue without any outlier and one with only a clash
+    rows = read_fixture("residue-analysis.out").decode("utf-8").splitlines()[1:]
+    mp = MolProbity(
+        engine=ReplayEngine({"residue-analysis": read_fixture("residue-analysis.out")})
+    )
+
+    assert len(mp.residue_analysis("model.pdb")) == len(rows) - 2